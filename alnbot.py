@@ -1,17 +1,37 @@
 import os
+import sys
 import random
 import asyncio
 import logging
 import shutil
-import math
+import sqlite3
+import threading
+import time
+import heapq
+import itertools
+import bisect
+import json
+import hashlib
+import hmac
+import html
+import socket
+import importlib.util
+import struct
+import tarfile
+import zipfile
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.types import CallbackQuery
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
-import schedule
-from aiohttp import web
+from aiohttp import ClientSession, ClientTimeout, web
+from yarl import URL
+from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
@@ -22,15 +42,23 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHAT_ID = os.getenv("CHAT_ID")
+# Несколько каналов/групп через запятую; по умолчанию — один CHAT_ID
+CHAT_IDS = [c.strip() for c in os.getenv("CHAT_IDS", CHAT_ID or "").split(",") if c.strip()]
 TICK_TOKEN = os.getenv("TICK_TOKEN", "")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
 APP_BASE_URL = os.getenv("RENDER_EXTERNAL_URL", "https://alnpost-bot.onrender.com").rstrip("/")
+# Свой Bot API сервер (локальный telegram-bot-api или заглушка из bench.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
 
 # Логи
 logging.basicConfig(level=logging.INFO)
 
 # Бот
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
 dp = Dispatcher()
 
 # Часовые пояса
@@ -40,20 +68,141 @@ SERVER_TZ = datetime.now().astimezone().tzinfo  # TZ сервера
 # ─────────────────────────────────────────────────────────────
 # Глобальные структуры
 # ─────────────────────────────────────────────────────────────
-material_pairs = []
+class MaterialQueue:
+    """Очередь пар (картинка, текст) в порядке публикации с индексом по пути картинки"""
+    __slots__ = ("_pairs", "version")
+
+    def __init__(self, pairs=()):
+        self._pairs = OrderedDict(pairs)  # image_path -> text_path
+        self.version = 0  # растёт при каждом изменении
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def __iter__(self):
+        return iter(self._pairs.items())
+
+    def __contains__(self, image_path):
+        return image_path in self._pairs
+
+    def first(self):
+        return next(iter(self._pairs.items()), None)
+
+    def head(self, count: int) -> list:
+        return list(itertools.islice(self._pairs.items(), count))
+
+    def extend(self, pairs) -> None:
+        self.version += 1
+        self._pairs.update(pairs)
+
+    def remove(self, image_path: str) -> bool:
+        self.version += 1
+        return self._pairs.pop(image_path, None) is not None
+
+    def clear(self) -> None:
+        self.version += 1
+        self._pairs.clear()
+
+material_pairs = MaterialQueue()
 PUBLICATIONS_PER_DAY = 2
 
-scheduled_tasks = []
+scheduled_tasks = []  # PlannedTask, отсортированы по времени; только в пределах горизонта
 _freq_lock = asyncio.Lock()
 
 # Пути к папкам
 base_path = os.path.dirname(os.path.abspath(__file__))
-materials_folder = os.path.join(base_path, "materials")
-pending_folder = os.path.join(base_path, "wait")
+materials_folder = os.path.abspath(os.getenv("MATERIALS_DIR", os.path.join(base_path, "materials")))
+pending_folder = os.path.abspath(os.getenv("WAIT_DIR", os.path.join(base_path, "wait")))
 
 os.makedirs(materials_folder, exist_ok=True)
 os.makedirs(pending_folder, exist_ok=True)
 
+# Локальное состояние (индексы, кэши) — не коммитится в git
+state_folder = os.getenv("STATE_DIR", os.path.join(base_path, "state"))
+os.makedirs(state_folder, exist_ok=True)
+DB_PATH = os.path.join(state_folder, "alnpost.sqlite3")
+JOURNAL_PATH = os.path.join(state_folder, "schedule.journal")
+JOURNAL_COMPACT_EVERY = int(os.getenv("JOURNAL_COMPACT_EVERY", "500"))
+PLAN_HORIZON_DAYS = float(os.getenv("PLAN_HORIZON_DAYS", "7"))
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "10000"))
+
+# Оптимизация изображений перед отправкой (нужен Pillow)
+OPTIMIZE_IMAGES = os.getenv("OPTIMIZE_IMAGES", "1") == "1"
+OPTIMIZE_WORKERS = int(os.getenv("OPTIMIZE_WORKERS", "1"))
+OPTIMIZE_MAX_SIDE = int(os.getenv("OPTIMIZE_MAX_SIDE", "2560"))  # Telegram всё равно ужимает до 2560
+OPTIMIZE_QUALITY = int(os.getenv("OPTIMIZE_QUALITY", "87"))
+OPTIMIZED_SUBDIR = ".opt"
+
+# Пул потоков для файловых операций (не блокируем event loop)
+IO_WORKERS = int(os.getenv("IO_WORKERS", "4"))
+
+# Лимиты Telegram: ~30 сообщений/с на бота, ~20 сообщений/мин в группу
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "30"))
+PER_CHAT_PER_MINUTE = float(os.getenv("PER_CHAT_PER_MINUTE", "20"))
+
+# Повторы неудачных отправок (экспоненциальная задержка с джиттером)
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "8"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "30"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "3600"))
+RETRY_MAX_IN_FLIGHT = int(os.getenv("RETRY_MAX_IN_FLIGHT", "4"))
+
+# Альбомы: посты, сработавшие в пределах окна, уходят одним send_media_group (0 — выключено)
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "0"))
+ALBUM_MAX_ITEMS = 10
+
+# Пропущенные публикации (инстанс спал/рестартовал): throttle | spread | skip
+CATCHUP_POLICY = os.getenv("CATCHUP_POLICY", "throttle")
+CATCHUP_GRACE = float(os.getenv("CATCHUP_GRACE", "120"))  # опоздание больше этого — пропущенная
+CATCHUP_INTERVAL = float(os.getenv("CATCHUP_INTERVAL", "5"))  # throttle: пауза между пропущенными
+CATCHUP_SPREAD_WINDOW = float(os.getenv("CATCHUP_SPREAD_WINDOW", "3600"))  # spread: растянуть на окно
+CATCHUP_MAX_AGE = float(os.getenv("CATCHUP_MAX_AGE", "21600"))  # skip: старше — не публикуем
+CATCHUP_CONCURRENCY = int(os.getenv("CATCHUP_CONCURRENCY", "1"))
+
+# Хранилище материалов: local (папки рядом со скриптом) или s3 (любое S3-совместимое)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+S3_ENDPOINT = os.getenv("S3_ENDPOINT", "").rstrip("/")
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY", "")
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY", "")
+S3_PREFIX = os.getenv("S3_PREFIX", "")  # ключи: <prefix>materials/..., <prefix>wait/...
+S3_LIST_TTL = float(os.getenv("S3_LIST_TTL", "60"))  # как часто очередь сверяется со списком объектов
+STORAGE_READAHEAD_CHUNKS = int(os.getenv("STORAGE_READAHEAD_CHUNKS", "4"))  # буфер потоковой загрузки, по 64 КиБ
+
+# Вебхук: ответ Telegram сразу, апдейты разбирает ограниченный пул воркеров
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "256"))  # на воркера; при переполнении — 503, Telegram повторит
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000"))  # сколько последних update_id помним
+
+# Ближайшие публикации заранее в памяти: подпись, хэш и байты фото (0 — выключено)
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", "3"))
+PREFETCH_MAX_BYTES = int(os.getenv("PREFETCH_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Одинаковые картинка+подпись (в том числе уже опубликованные) в очередь не ставим: skip | report | off
+DEDUP_MODE = os.getenv("DEDUP_MODE", "skip")
+
+# Наблюдение за materials/wait: новые пары попадают в очередь без перезагрузки
+WATCH_FOLDERS = os.getenv("WATCH_FOLDERS", "0") == "1"
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", "2"))  # тишина перед приёмом пачки файлов
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", "10"))  # опрос, если inotify недоступен
+
+# Несколько реплик с общим STATE_DIR: вебхуки принимают все, планировщик ведёт только держатель аренды
+LEADER_ELECTION = os.getenv("LEADER_ELECTION", "0") == "1"
+LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))  # без продления аренда освобождается через столько секунд
+LEASE_RENEW_INTERVAL = float(os.getenv("LEASE_RENEW_INTERVAL", "10"))
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Адрес этой реплики для других: ведомые пересылают сюда команды, меняющие план
+REPLICA_URL = os.getenv("REPLICA_URL", f"http://127.0.0.1:{os.getenv('PORT', '10000')}").rstrip("/")
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+# Кто может загружать архивы с материалами прямо в бота (пусто — никто)
+ADMIN_IDS = {int(i) for i in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if i}
+# Облачный Bot API отдаёт ботам файлы до 20 МБ, свой сервер — до 2 ГБ
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str((2000 if TELEGRAM_API_URL else 20) * 1024 * 1024)))
+UPLOAD_MAX_UNPACKED = int(os.getenv("UPLOAD_MAX_UNPACKED", str(4 * 1024 * 1024 * 1024)))  # защита от zip-бомб
+CAPTION_MAX_LENGTH = 1024
+
 is_test_mode = False
 original_material_pairs = []
 
@@ -74,10 +223,14 @@ def describe_part_of_day(dt_local: datetime) -> str:
     else:
         return "🌙 Ночь"
 
-def random_time(start_hour, end_hour):
-    hour = random.randint(start_hour, end_hour)
-    minute = random.randint(0, 59)
-    return f"{hour:02d}:{minute:02d}"
+def day_windows(freq: int):
+    if freq <= 1:
+        return [(9, 11, "утро")]  # 9-11 утра
+    if freq == 2:
+        return [(8, 11, "утро"), (18, 21, "вечер")]  # Утро и вечер
+    if freq == 3:
+        return [(8, 11, "утро"), (12, 17, "день"), (18, 21, "вечер")]
+    return [(8, 10, "раннее утро"), (11, 13, "полдень"), (14, 17, "день"), (18, 21, "вечер")]
 
 # ─────────────────────────────────────────────────────────────
 # UI
@@ -96,127 +249,2513 @@ def get_main_keyboard():
     return keyboard
 
 # ─────────────────────────────────────────────────────────────
-# Работа с очередью/файлами
+# База состояния (SQLite)
 # ─────────────────────────────────────────────────────────────
-def refresh_material_queue():
-    global material_pairs
-    valid_pairs = []
-    removed_count = 0
-    for image_path, text_path in material_pairs:
-        if os.path.exists(image_path) and os.path.exists(text_path):
-            valid_pairs.append((image_path, text_path))
-        else:
-            logging.warning(f"Удалена пара: {image_path}, {text_path}")
-            removed_count += 1
-    material_pairs = valid_pairs
-    if removed_count > 0:
-        logging.info(f"Очередь обновлена: удалено {removed_count}, осталось: {len(material_pairs)}")
-
-def load_and_move_materials():
-    global material_pairs
-    logging.info("=== ЗАГРУЗКА МАТЕРИАЛОВ ===")
-    material_pairs = []
-    
-    # Проверяем папку wait (файлы, которые уже в очереди)
-    wait_files = os.listdir(pending_folder) if os.path.exists(pending_folder) else []
-    wait_images = [f for f in wait_files if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp'))]
-    wait_texts = [f for f in wait_files if f.lower().endswith('.txt')]
-
-    for image in wait_images:
-        image_name = os.path.splitext(image)[0]
-        text_file = next((txt for txt in wait_texts if os.path.splitext(txt)[0] == image_name), None)
-        if text_file:
-            image_path = os.path.join(pending_folder, image)
-            text_path = os.path.join(pending_folder, text_file)
-            if os.path.exists(image_path) and os.path.exists(text_path):
-                material_pairs.append((image_path, text_path))
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS folder_index (
+    folder       TEXT PRIMARY KEY,
+    dir_mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS material_index (
+    folder   TEXT NOT NULL,
+    name     TEXT NOT NULL,
+    stem     TEXT NOT NULL,
+    kind     TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size     INTEGER NOT NULL,
+    PRIMARY KEY (folder, name)
+);
+CREATE TABLE IF NOT EXISTS file_ids (
+    sha256    TEXT PRIMARY KEY,
+    file_id   TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS file_ids_lru ON file_ids (last_used);
+CREATE TABLE IF NOT EXISTS outbox (
+    image_path TEXT NOT NULL,
+    chat_id    TEXT NOT NULL,
+    text_path  TEXT NOT NULL,
+    task_idx   INTEGER,
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    next_at    REAL NOT NULL,
+    last_error TEXT,
+    PRIMARY KEY (image_path, chat_id)
+);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    image_path TEXT NOT NULL,
+    chat_id    TEXT NOT NULL,
+    text_path  TEXT NOT NULL,
+    task_idx   INTEGER,
+    attempts   INTEGER NOT NULL,
+    last_error TEXT,
+    failed_at  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS content_hashes (
+    path     TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size     INTEGER NOT NULL,
+    sha256   TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS image_checks (
+    path     TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size     INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS published_hashes (
+    image_sha256   TEXT NOT NULL,
+    caption_sha256 TEXT NOT NULL,
+    name           TEXT NOT NULL,
+    published_at   REAL NOT NULL,
+    PRIMARY KEY (image_sha256, caption_sha256)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name       TEXT PRIMARY KEY,
+    holder     TEXT NOT NULL,
+    holder_url TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+_db = None
+_db_lock = threading.RLock()
+
+def get_db() -> sqlite3.Connection:
+    global _db
+    with _db_lock:
+        if _db is None:
+            _db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+            _db.execute("PRAGMA journal_mode=WAL")
+            _db.execute("PRAGMA synchronous=NORMAL")
+            _db.executescript(DB_SCHEMA)
+        return _db
 
-    # Если в wait пусто — берём из materials
-    if not material_pairs:
-        materials_files = os.listdir(materials_folder) if os.path.exists(materials_folder) else []
-        images = [f for f in materials_files if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp'))]
-        texts = [f for f in materials_files if f.lower().endswith('.txt')]
-
-        for image in images:
-            image_name = os.path.splitext(image)[0]
-            text_file = next((txt for txt in texts if os.path.splitext(txt)[0] == image_name), None)
-            if text_file:
-                src_image = os.path.join(materials_folder, image)
-                src_text = os.path.join(materials_folder, text_file)
-                dst_image = os.path.join(pending_folder, image)
-                dst_text = os.path.join(pending_folder, text_file)
+# ─────────────────────────────────────────────────────────────
+# Индекс материалов (по stem, с mtime/size)
+# ─────────────────────────────────────────────────────────────
+# folder -> {"dir_mtime_ns": int | None, "entries": {name: (stem, kind, mtime_ns, size)}, "stats": FolderStats}
+_material_index = {}
+_index_lock = threading.RLock()
+INDEX_PERSIST_CHUNK = 1000  # строк индекса на транзакцию
+
+class FolderStats:
+    """Счётчики папки, которые правятся на каждое добавление/удаление файла за O(1)"""
+    __slots__ = ("files", "pairs", "orphans", "_stems")
+
+    def __init__(self):
+        self.files = 0
+        self.pairs = 0
+        self.orphans = 0  # картинки без подписи, подписи без картинки, лишние картинки того же stem
+        self._stems = {}  # stem -> [картинок, подписей]
+
+    @staticmethod
+    def _contribution(images: int, texts: int) -> tuple:
+        if images and texts:
+            return 1, images + texts - 2
+        return 0, images + texts
+
+    def _change(self, stem: str, kind: str, delta: int) -> None:
+        self.files += delta
+        if kind not in ("image", "text"):
+            return
+        counts = self._stems.setdefault(stem, [0, 0])
+        pairs, orphans = self._contribution(*counts)
+        counts[0 if kind == "image" else 1] += delta
+        new_pairs, new_orphans = self._contribution(*counts)
+        self.pairs += new_pairs - pairs
+        self.orphans += new_orphans - orphans
+        if counts == [0, 0]:
+            del self._stems[stem]
+
+    def add(self, stem: str, kind: str) -> None:
+        self._change(stem, kind, 1)
+
+    def remove(self, stem: str, kind: str) -> None:
+        self._change(stem, kind, -1)
+
+    @classmethod
+    def from_names(cls, names) -> "FolderStats":
+        stats = cls()
+        for name in names:
+            stats.add(*classify_material(name))
+        return stats
+
+    def snapshot(self) -> tuple:
+        return self.files, self.pairs, self.orphans
+
+def classify_material(name: str):
+    stem, ext = os.path.splitext(name)
+    ext = ext.lower()
+    if ext in IMAGE_EXTENSIONS:
+        return stem, "image"
+    if ext == ".txt":
+        return stem, "text"
+    return stem, "other"
+
+def _get_folder_index(folder: str) -> dict:
+    cached = _material_index.get(folder)
+    if cached is not None:
+        return cached
+    with _db_lock:
+        db = get_db()
+        row = db.execute("SELECT dir_mtime_ns FROM folder_index WHERE folder = ?", (folder,)).fetchone()
+        rows = db.execute(
+            "SELECT name, stem, kind, mtime_ns, size FROM material_index WHERE folder = ?", (folder,)
+        ).fetchall()
+    cached = {
+        "dir_mtime_ns": row[0] if row else None,
+        "entries": {name: (stem, kind, mtime_ns, size) for name, stem, kind, mtime_ns, size in rows},
+        "stats": FolderStats(),
+    }
+    for stem, kind, _mtime, _size in cached["entries"].values():
+        cached["stats"].add(stem, kind)
+    _material_index[folder] = cached
+    return cached
+
+def _persist_folder_index(folder: str, dir_mtime_ns, changed: dict, removed) -> None:
+    """Пишет изменения транзакциями по INDEX_PERSIST_CHUNK строк и отпускает _db_lock между ними,
+    чтобы отправки и обработчики не ждали весь массовый приём"""
+    ops = [("DELETE FROM material_index WHERE folder = ? AND name = ?", (folder, name)) for name in removed]
+    ops += [
+        (
+            "INSERT OR REPLACE INTO material_index (folder, name, stem, kind, mtime_ns, size) VALUES (?, ?, ?, ?, ?, ?)",
+            (folder, name, *meta),
+        )
+        for name, meta in changed.items()
+    ]
+    if len(ops) > INDEX_PERSIST_CHUNK:
+        # Пока пишутся пачки, папка числится непроиндексированной: после сбоя посередине её просто перечитают
+        ops.insert(0, ("DELETE FROM folder_index WHERE folder = ?", (folder,)))
+    if dir_mtime_ns is None:
+        ops.append(("DELETE FROM folder_index WHERE folder = ?", (folder,)))
+    else:
+        ops.append(("INSERT OR REPLACE INTO folder_index (folder, dir_mtime_ns) VALUES (?, ?)", (folder, dir_mtime_ns)))
+    for start in range(0, len(ops), INDEX_PERSIST_CHUNK):
+        with _db_lock:
+            db = get_db()
+            db.execute("BEGIN")
+            try:
+                for sql, params in ops[start:start + INDEX_PERSIST_CHUNK]:
+                    db.execute(sql, params)
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+def scan_folder(folder: str) -> dict:
+    """Возвращает {имя: (stem, kind, mtime_ns, size)}; папка перечитывается только если изменилась"""
+    with _index_lock:
+        return _scan_folder_locked(folder)
+
+def _scan_folder_locked(folder: str) -> dict:
+    cached = _get_folder_index(folder)
+    try:
+        # mtime каталога берём ДО обхода: изменения во время обхода поймаем в следующий раз
+        dir_mtime_ns = os.stat(folder).st_mtime_ns
+    except FileNotFoundError:
+        if cached["entries"]:
+            _persist_folder_index(folder, None, {}, list(cached["entries"]))
+        cached["dir_mtime_ns"], cached["entries"], cached["stats"] = None, {}, FolderStats()
+        return cached["entries"]
+
+    if dir_mtime_ns == cached["dir_mtime_ns"]:
+        return cached["entries"]
+
+    old_entries = cached["entries"]
+    entries = {}
+    changed = {}
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            meta = (*classify_material(entry.name), st.st_mtime_ns, st.st_size)
+            entries[entry.name] = meta
+            if old_entries.get(entry.name) != meta:
+                changed[entry.name] = meta
+    removed = [name for name in old_entries if name not in entries]
+
+    stats = cached["stats"]
+    for name in changed:
+        if name not in old_entries:
+            stats.add(*changed[name][:2])
+    for name in removed:
+        stats.remove(*old_entries[name][:2])
+
+    _persist_folder_index(folder, dir_mtime_ns, changed, removed)
+    cached["dir_mtime_ns"], cached["entries"] = dir_mtime_ns, entries
+    if changed or removed:
+        logging.info(f"Индекс {os.path.basename(folder)}: изменено {len(changed)}, удалено {len(removed)}, всего {len(entries)}")
+    return entries
+
+def index_entry(path: str):
+    """(stem, kind, mtime_ns, size) файла из индекса в памяти, без обращения к диску"""
+    with _index_lock:
+        return _get_folder_index(os.path.dirname(path))["entries"].get(os.path.basename(path))
+
+def folder_names(folder: str) -> set:
+    with _index_lock:
+        return set(_scan_folder_locked(folder))
+
+def index_is_fresh(folder: str) -> bool:
+    cached = _get_folder_index(folder)
+    try:
+        return cached["dir_mtime_ns"] == os.stat(folder).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+def folder_stats(folder: str) -> tuple:
+    """(файлов, пар, без пары) из памяти; папка перечитывается, только если изменилась извне"""
+    with _index_lock:
+        _scan_folder_locked(folder)
+        return _material_index[folder]["stats"].snapshot()
+
+def index_generation(folder: str):
+    """mtime каталога, на момент которого индекс верен; None — индекс устарел.
+    Зовётся с loop: уже загруженный индекс читается без _index_lock, который скан держит на весь обход"""
+    cached = _material_index.get(folder)
+    if cached is not None:
+        return cached["dir_mtime_ns"]
+    with _index_lock:
+        return _get_folder_index(folder)["dir_mtime_ns"]
+
+def index_update(folder: str, added=(), removed=(), was_fresh: bool = True) -> None:
+    """Учитывает в индексе собственные перемещения/удаления без повторного обхода папки"""
+    with _index_lock:
+        _index_update_locked(folder, added, removed, was_fresh)
+
+def _index_update_locked(folder: str, added, removed, was_fresh: bool) -> None:
+    cached = _get_folder_index(folder)
+    entries = cached["entries"]
+    stats = cached["stats"]
+    changed = {}
+    for name in added:
+        try:
+            st = os.stat(os.path.join(folder, name))
+        except FileNotFoundError:
+            continue
+        if name not in entries:
+            stats.add(*classify_material(name))
+        changed[name] = entries[name] = (*classify_material(name), st.st_mtime_ns, st.st_size)
+    for name in removed:
+        meta = entries.pop(name, None)
+        if meta is not None:
+            stats.remove(*meta[:2])
+    try:
+        dir_mtime_ns = os.stat(folder).st_mtime_ns
+    except FileNotFoundError:
+        dir_mtime_ns = None
+    # Если индекс был устаревшим ещё до нашей операции — не выдаём его за свежий
+    if not was_fresh:
+        dir_mtime_ns = None
+    cached["dir_mtime_ns"] = dir_mtime_ns
+    _persist_folder_index(folder, dir_mtime_ns, changed, list(removed))
+
+def pair_folder(folder: str) -> list:
+    """Пары (image_name, text_name) за один линейный проход по индексу"""
+    return _pair_classified((name, stem, kind) for name, (stem, kind, _mtime, _size) in scan_folder(folder).items())
+
+def pair_names(names) -> list:
+    """То же для произвольного списка имён (например, ключей объектного хранилища)"""
+    return _pair_classified((name, *classify_material(name)) for name in names)
+
+def _pair_classified(items) -> list:
+    images, texts = {}, {}
+    for name, stem, kind in items:
+        if kind == "image":
+            if stem not in images or name < images[stem]:
+                images[stem] = name
+        elif kind == "text":
+            texts[stem] = name
+    return [(images[stem], texts[stem]) for stem in sorted(images) if stem in texts]
+
+# ─────────────────────────────────────────────────────────────
+# Асинхронное хранилище (файловые операции в пуле потоков)
+# ─────────────────────────────────────────────────────────────
+_io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+async def run_io(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_io_executor, func, *args)
+
+def _missing_pairs(pairs) -> tuple:
+    """Сверка очереди с индексом wait: без stat на каждый файл; возвращает (поколение, пропавшие)"""
+    entries = scan_folder(pending_folder)
+    generation = index_generation(pending_folder)
+    missing = [
+        (image_path, text_path)
+        for image_path, text_path in pairs
+        if os.path.dirname(image_path) != pending_folder
+        or os.path.basename(image_path) not in entries
+        or os.path.basename(text_path) not in entries
+    ]
+    return generation, missing
+
+def _read_pair(image_path: str, text_path: str):
+    """Проверка наличия, подпись, путь к фото и его хэш — за один переход в пул"""
+    for path in (image_path, text_path):
+        if not os.path.exists(path):
+            logging.error(f"Файл не найден: {path}")
+            return None
+    with open(text_path, 'r', encoding='utf-8') as f:
+        caption = f.read().strip()
+    photo_path = photo_path_for(image_path)
+    return caption, photo_path, file_sha256(photo_path)
+
+def _remove_pair_files(image_path: str, text_path: str) -> None:
+    folder = os.path.dirname(image_path)
+    was_fresh = index_is_fresh(folder)
+    removed = []
+    for path in (image_path, text_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed.append(os.path.basename(path))
+        logging.info(f"Удален: {os.path.basename(path)}")
+    if removed:
+        index_update(folder, removed=removed, was_fresh=was_fresh)
+    remove_optimized_variant(image_path)
+
+def _remove_pairs_files(pairs) -> None:
+    for image_path, text_path in pairs:
+        _remove_pair_files(image_path, text_path)
+
+def _read_pairs(pairs) -> list:
+    return [_read_pair(image_path, text_path) for image_path, text_path in pairs]
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def _add_files(staging: str, names) -> None:
+    """Переносит готовые файлы в materials и сразу учитывает их в индексе"""
+    was_fresh = index_is_fresh(materials_folder)
+    for name in names:
+        shutil.move(os.path.join(staging, name), os.path.join(materials_folder, name))
+    index_update(materials_folder, added=names, was_fresh=was_fresh)
+
+def _clear_folder(folder: str) -> int:
+    """Удаляет все файлы папки одним проходом scandir"""
+    deleted = 0
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
                 try:
-                    if os.path.exists(src_image) and os.path.exists(src_text):
-                        shutil.move(src_image, dst_image)
-                        shutil.move(src_text, dst_text)
-                        material_pairs.append((dst_image, dst_text))
-                        logging.info(f"Перемещено: {image} + {text_file}")
+                    if entry.is_file():
+                        os.remove(entry.path)
+                        deleted += 1
                 except Exception as e:
-                    logging.error(f"Ошибка перемещения {image}: {e}")
+                    logging.error(f"Ошибка {entry.name}: {e}")
+    except FileNotFoundError:
+        return 0
+    except Exception as e:
+        logging.error(f"Ошибка {os.path.basename(folder)}: {e}")
+    shutil.rmtree(os.path.join(folder, OPTIMIZED_SUBDIR), ignore_errors=True)
+    scan_folder(folder)
+    return deleted
 
-    random.shuffle(material_pairs)
-    logging.info(f"Загружено {len(material_pairs)} публикаций.")
+# ─────────────────────────────────────────────────────────────
+# Хранилища материалов (local / S3)
+# ─────────────────────────────────────────────────────────────
+# Очередь, план и журнал всегда оперируют путями вида <base_path>/wait/<имя>;
+# хранилище решает, где эти файлы на самом деле лежат.
+class StorageError(Exception):
+    pass
+
+class LocalStorage:
+    """Файлы на локальном диске: индекс, оптимизация и наблюдение за папками работают только здесь"""
+    local = True
+
+    def generation(self):
+        return _wait_generation()
+
+    async def collect(self, move_new: bool = False) -> list:
+        return await run_io(collect_material_pairs, move_new)
+
+    async def missing_pairs(self, pairs) -> tuple:
+        return await run_io(_missing_pairs, pairs)
+
+    async def read_pair(self, image_path: str, text_path: str):
+        """(подпись, ссылка на фото, digest) или None, если пары уже нет"""
+        return await run_io(_read_pair, image_path, text_path)
+
+    async def read_pairs(self, pairs) -> list:
+        return await run_io(_read_pairs, pairs)
+
+    async def remove_pairs(self, pairs) -> None:
+        await run_io(_remove_pairs_files, pairs)
+
+    async def names(self, folder: str) -> set:
+        return await run_io(folder_names, folder)
+
+    async def add_files(self, staging: str, names) -> None:
+        await run_io(_add_files, staging, names)
+
+    async def clear(self, folder: str) -> int:
+        return await run_io(_clear_folder, folder)
+
+    async def stats(self, folder: str) -> tuple:
+        return await run_io(folder_stats, folder)
+
+    async def read_bytes(self, photo_ref: str) -> bytes:
+        return await run_io(_read_file, photo_ref)
+
+    def input_file(self, photo_ref: str) -> types.InputFile:
+        return types.FSInputFile(photo_ref)
+
+    async def close(self) -> None:
+        pass
+
+S3_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+class S3Storage:
+    """S3-совместимое хранилище (AWS, MinIO, R2...): запросы подписываются SigV4, фото уходят в Telegram потоком"""
+    local = False
+
+    def __init__(self, endpoint: str, bucket: str, region: str, access_key: str, secret_key: str, prefix: str = ""):
+        if not endpoint or not bucket:
+            raise StorageError("Для STORAGE_BACKEND=s3 нужны S3_ENDPOINT и S3_BUCKET")
+        self.endpoint = endpoint
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.prefix = prefix
+        # Логические папки бакета: ключи не зависят от того, где MATERIALS_DIR/WAIT_DIR лежат на диске
+        self.folders = {materials_folder: "materials", pending_folder: "wait"}
+        self._host = URL(endpoint).raw_authority
+        self._session = None
+
+    def key_for(self, path: str) -> str:
+        """<prefix><папка>[/<имя>] для папки материалов или файла в ней"""
+        if path in self.folders:
+            return self.prefix + self.folders[path]
+        folder, name = os.path.split(path)
+        if folder not in self.folders:
+            raise StorageError(f"Путь вне папок материалов: {path}")
+        return f"{self.prefix}{self.folders[folder]}/{name}"
+
+    def _signed_headers(self, method: str, raw_path: str, raw_query: str, headers: dict, payload_hash: str) -> dict:
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        scope = f"{now:%Y%m%d}/{self.region}/s3/aws4_request"
+        headers = {k.lower(): str(v).strip() for k, v in headers.items()}
+        headers.update({"host": self._host, "x-amz-date": amz_date, "x-amz-content-sha256": payload_hash})
+        signed = sorted(headers)
+        canonical_request = "\n".join([
+            method, raw_path, raw_query,
+            "".join(f"{name}:{headers[name]}\n" for name in signed),
+            ";".join(signed), payload_hash,
+        ])
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ])
+        key = ("AWS4" + self.secret_key).encode()
+        for part in (f"{now:%Y%m%d}", self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={';'.join(signed)}, Signature={signature}"
+        )
+        del headers["host"]
+        return headers
+
+    def request(self, method: str, key: str = "", query: dict = None, headers: dict = None, data=None):
+        """Подписанный запрос к бакету (path-style); возвращает контекст-менеджер ответа aiohttp.
+        Тело (data) не хэшируется — отправляется потоком как UNSIGNED-PAYLOAD"""
+        if self._session is None:
+            self._session = ClientSession()
+        raw_path = quote(f"/{self.bucket}/{key}" if key else f"/{self.bucket}", safe="/-_.~")
+        raw_query = "&".join(
+            f"{quote(k, safe='-_.~')}={quote(str(v), safe='-_.~')}" for k, v in sorted((query or {}).items())
+        )
+        payload_hash = EMPTY_SHA256 if data is None else "UNSIGNED-PAYLOAD"
+        signed = self._signed_headers(method, raw_path, raw_query, headers or {}, payload_hash)
+        url = URL(f"{self.endpoint}{raw_path}" + (f"?{raw_query}" if raw_query else ""), encoded=True)
+        return self._session.request(method, url, headers=signed, data=data)
+
+    @staticmethod
+    async def _check(resp) -> None:
+        if resp.status >= 300:
+            raise StorageError(f"S3 {resp.method} {resp.url.path}: HTTP {resp.status} {(await resp.text())[:200]}")
+
+    async def _list(self, folder: str) -> list:
+        import xml.etree.ElementTree as ET  # XML нужен только бэкенду s3
+        prefix = self.key_for(folder) + "/"
+        names = []
+        token = None
+        while True:
+            query = {"list-type": "2", "prefix": prefix}
+            if token:
+                query["continuation-token"] = token
+            async with self.request("GET", query=query) as resp:
+                await self._check(resp)
+                root = ET.fromstring(await resp.read())
+            for item in root.iter(f"{S3_NS}Contents"):
+                name = item.findtext(f"{S3_NS}Key")[len(prefix):]
+                # Как и на диске: без «подпапок» и скрытых файлов
+                if name and "/" not in name and not name.startswith("."):
+                    names.append(name)
+            if root.findtext(f"{S3_NS}IsTruncated") != "true":
+                return names
+            token = root.findtext(f"{S3_NS}NextContinuationToken")
+
+    async def _delete(self, path: str) -> None:
+        async with self.request("DELETE", self.key_for(path)) as resp:
+            await self._check(resp)
+
+    async def _move(self, src: str, dst: str) -> None:
+        source = quote(f"/{self.bucket}/{self.key_for(src)}", safe="/-_.~")
+        async with self.request("PUT", self.key_for(dst), headers={"x-amz-copy-source": source}) as resp:
+            await self._check(resp)
+        await self._delete(src)
+
+    def generation(self):
+        # Дешёвого признака изменений у бакета нет — список объектов сверяем не чаще раза в S3_LIST_TTL
+        return int(time.time() // S3_LIST_TTL)
+
+    async def collect(self, move_new: bool = False) -> list:
+        waiting = await self._list(pending_folder)
+        pairs = [
+            (os.path.join(pending_folder, image), os.path.join(pending_folder, text_file))
+            for image, text_file in pair_names(waiting)
+        ]
+        if pairs and not move_new:
+            return pairs
+
+        taken = set(waiting)
+        for image, text_file in pair_names(await self._list(materials_folder)):
+            if image in taken or text_file in taken:
+                logging.warning(f"Пропущено: {image} уже есть в wait")
+                continue
+            dst_image = os.path.join(pending_folder, image)
+            dst_text = os.path.join(pending_folder, text_file)
+            try:
+                await self._move(os.path.join(materials_folder, image), dst_image)
+                await self._move(os.path.join(materials_folder, text_file), dst_text)
+                pairs.append((dst_image, dst_text))
+                logging.info(f"Перемещено: {image} + {text_file}")
+            except Exception as e:
+                logging.error(f"Ошибка перемещения {image}: {e}")
+        return pairs
+
+    async def missing_pairs(self, pairs) -> tuple:
+        generation = self.generation()
+        names = set(await self._list(pending_folder))
+        missing = [
+            (image_path, text_path)
+            for image_path, text_path in pairs
+            if os.path.basename(image_path) not in names or os.path.basename(text_path) not in names
+        ]
+        return generation, missing
+
+    async def read_pair(self, image_path: str, text_path: str):
+        async with self.request("GET", self.key_for(text_path)) as resp:
+            if resp.status == 404:
+                logging.error(f"Файл не найден: {text_path}")
+                return None
+            await self._check(resp)
+            caption = (await resp.text(encoding="utf-8")).strip()
+        async with self.request("HEAD", self.key_for(image_path)) as resp:
+            if resp.status == 404:
+                logging.error(f"Файл не найден: {image_path}")
+                return None
+            await self._check(resp)
+            etag = resp.headers.get("ETag", "").strip('"')
+        # ETag неизменного объекта стабилен — годится ключом кэша file_id
+        return caption, image_path, f"s3:{self.key_for(image_path)}:{etag}"
+
+    async def read_pairs(self, pairs) -> list:
+        return await asyncio.gather(*(self.read_pair(image_path, text_path) for image_path, text_path in pairs))
+
+    async def names(self, folder: str) -> set:
+        return set(await self._list(folder))
+
+    async def add_files(self, staging: str, names) -> None:
+        async def upload(name):
+            path = os.path.join(staging, name)
+            with open(path, "rb") as f:
+                async with self.request("PUT", self.key_for(os.path.join(materials_folder, name)), data=f) as resp:
+                    await self._check(resp)
+        for start in range(0, len(names), 16):
+            await asyncio.gather(*(upload(name) for name in names[start:start + 16]))
+
+    async def remove_pairs(self, pairs) -> None:
+        async def remove(path):
+            try:
+                await self._delete(path)
+                logging.info(f"Удален: {os.path.basename(path)}")
+            except Exception as e:
+                logging.error(f"Ошибка удаления {os.path.basename(path)}: {e}")
+        await asyncio.gather(*(remove(path) for pair in pairs for path in pair))
 
-def remove_sent_files(image_path, text_path):
-    """Удаляет опубликованные файлы из папки wait"""
+    async def clear(self, folder: str) -> int:
+        names = await self._list(folder)
+        await asyncio.gather(*(self._delete(os.path.join(folder, name)) for name in names))
+        return len(names)
+
+    async def stats(self, folder: str) -> tuple:
+        # Локального индекса у бакета нет — считаем по списку объектов
+        return FolderStats.from_names(await self._list(folder)).snapshot()
+
+    async def read_bytes(self, photo_ref: str) -> bytes:
+        async with self.request("GET", self.key_for(photo_ref)) as resp:
+            await self._check(resp)
+            return await resp.read()
+
+    def input_file(self, photo_ref: str) -> types.InputFile:
+        return S3InputFile(self, self.key_for(photo_ref), os.path.basename(photo_ref))
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+class S3InputFile(types.InputFile):
+    """Объект S3 потоком уходит в multipart-загрузку Telegram; впереди читается не больше readahead кусков"""
+
+    def __init__(self, storage: S3Storage, key: str, filename: str, readahead: int = STORAGE_READAHEAD_CHUNKS):
+        super().__init__(filename=filename, chunk_size=64 * 1024)
+        self.storage = storage
+        self.key = key
+        self.readahead = readahead
+
+    async def read(self, bot):
+        buffer = asyncio.Queue(maxsize=max(1, self.readahead))
+
+        async def pump():
+            try:
+                async with self.storage.request("GET", self.key) as resp:
+                    await self.storage._check(resp)
+                    async for chunk in resp.content.iter_chunked(self.chunk_size):
+                        await buffer.put(chunk)
+                await buffer.put(None)
+            except Exception as e:
+                await buffer.put(e)
+
+        # Повторная отправка (retry) вызовет read() ещё раз — объект будет прочитан заново
+        reader = asyncio.create_task(pump())
+        try:
+            while (chunk := await buffer.get()) is not None:
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            reader.cancel()
+
+if STORAGE_BACKEND == "s3":
+    storage = S3Storage(S3_ENDPOINT, S3_BUCKET, S3_REGION, S3_ACCESS_KEY, S3_SECRET_KEY, S3_PREFIX)
+else:
+    storage = LocalStorage()
+
+# ─────────────────────────────────────────────────────────────
+# Дедупликация по содержимому
+# ─────────────────────────────────────────────────────────────
+_content_hashes = None  # rel_path -> (mtime_ns, size, sha256): копия таблицы content_hashes
+_published_keys = None  # {(sha256 картинки, отпечаток подписи)}
+last_duplicates = []  # [(image_path, причина)] последнего приёма
+
+def caption_fingerprint(text: str) -> str:
+    """Подписи, отличающиеся только пробелами и регистром, считаются одинаковыми"""
+    return hashlib.sha256(" ".join(text.split()).casefold().encode()).hexdigest()
+
+def _hash_file(path: str, kind: str) -> str:
+    if kind == "text":
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return caption_fingerprint(f.read())
+    return file_sha256(path)
+
+def _cached_hashes(paths) -> tuple:
+    """({path: хэш} из кэша, [(path, kind, mtime_ns, size)] к пересчёту); mtime/size — из индекса, без stat"""
+    global _content_hashes
+    # Индекс читаем до _db_lock: индекс сам берёт _db_lock внутри _index_lock, вложенность в обратном порядке — взаимоблокировка
+    entries = [(path, index_entry(path)) for path in paths]
+    with _db_lock:
+        if _content_hashes is None:
+            rows = get_db().execute("SELECT path, mtime_ns, size, sha256 FROM content_hashes")
+            _content_hashes = {path: (mtime_ns, size, digest) for path, mtime_ns, size, digest in rows}
+        known, stale = {}, []
+        for path, meta in entries:
+            if meta is None:
+                continue
+            _stem, kind, mtime_ns, size = meta
+            cached = _content_hashes.get(_rel_path(path))
+            if cached is not None and cached[:2] == (mtime_ns, size):
+                known[path] = cached[2]
+            else:
+                stale.append((path, kind, mtime_ns, size))
+    return known, stale
+
+def _store_hashes(rows) -> None:
+    with _db_lock:
+        get_db().executemany(
+            "INSERT OR REPLACE INTO content_hashes (path, mtime_ns, size, sha256) VALUES (?, ?, ?, ?)", rows
+        )
+        if _content_hashes is not None:  # сброшенный кэш перечитается из базы вместе с этими строками
+            for path, mtime_ns, size, digest in rows:
+                _content_hashes[path] = (mtime_ns, size, digest)
+
+async def content_hashes(paths) -> dict:
+    """Хэши содержимого; заново считаются только новые и изменившиеся файлы, параллельно в пуле"""
+    known, stale = await run_io(_cached_hashes, paths)
+    if stale:
+        digests = await asyncio.gather(
+            *(run_io(_hash_file, path, kind) for path, kind, _, _ in stale), return_exceptions=True
+        )
+        rows = []
+        for (path, _kind, mtime_ns, size), digest in zip(stale, digests):
+            if isinstance(digest, Exception):
+                logging.warning(f"Хэш {os.path.basename(path)} не посчитан: {digest}")
+                continue
+            known[path] = digest
+            rows.append((_rel_path(path), mtime_ns, size, digest))
+        await run_io(_store_hashes, rows)
+        logging.info(f"Хэши содержимого: из кэша {len(known) - len(rows)}, посчитано {len(rows)}")
+    return known
+
+def _load_published_keys() -> set:
+    global _published_keys
+    with _db_lock:
+        if _published_keys is None:
+            rows = get_db().execute("SELECT image_sha256, caption_sha256 FROM published_hashes")
+            _published_keys = {tuple(row) for row in rows}
+        return _published_keys
+
+def _store_published(rows, paths) -> None:
+    with _db_lock:
+        _load_published_keys()
+        db = get_db()
+        db.executemany(
+            "INSERT OR IGNORE INTO published_hashes (image_sha256, caption_sha256, name, published_at) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        # Файлы сейчас удалятся — их строки в кэше хэшей больше не нужны
+        db.executemany("DELETE FROM content_hashes WHERE path = ?", [(path,) for path in paths])
+        if _content_hashes is not None:
+            for path in paths:
+                _content_hashes.pop(path, None)
+        _published_keys.update((image_hash, caption_hash) for image_hash, caption_hash, _, _ in rows)
+
+def reset_dedup_caches() -> None:
+    """Следующее обращение перечитает хэши и опубликованное из базы (её пишут все реплики по очереди)"""
+    global _content_hashes, _published_keys
+    with _db_lock:
+        _content_hashes = None
+        _published_keys = None
+
+async def record_published(pairs) -> None:
+    """Запоминает содержимое опубликованных пар, чтобы не поставить его в очередь снова"""
+    if DEDUP_MODE == "off" or not storage.local:
+        return
+    hashes = await content_hashes([path for pair in pairs for path in pair])
+    now = time.time()
+    rows = [
+        (hashes[img], hashes[txt], os.path.basename(img), now)
+        for img, txt in pairs if img in hashes and txt in hashes
+    ]
+    await run_io(_store_published, rows, [_rel_path(path) for pair in pairs for path in pair])
+
+async def dedup_pairs(pairs, queued=()) -> list:
+    """Отсекает повторы до планирования: внутри пачки, с очередью (queued) и с уже опубликованным"""
+    global last_duplicates
+    last_duplicates = []
+    if DEDUP_MODE == "off" or not storage.local or not pairs:
+        return pairs
+    queued = list(queued)
+    hashes = await content_hashes([path for pair in (*queued, *pairs) for path in pair])
+    published = await run_io(_load_published_keys)
+
+    seen = {}
+    for img, txt in queued:
+        seen.setdefault((hashes.get(img), hashes.get(txt)), img)
+    unique = []
+    for img, txt in pairs:
+        key = (hashes.get(img), hashes.get(txt))
+        if None in key:
+            unique.append((img, txt))  # не прочитали — решит отправка
+            continue
+        if key in published:
+            last_duplicates.append((img, "уже публиковалось"))
+        elif key in seen:
+            last_duplicates.append((img, f"повтор {os.path.basename(seen[key])}"))
+        else:
+            seen[key] = img
+            unique.append((img, txt))
+            continue
+        if DEDUP_MODE == "report":
+            unique.append((img, txt))
+    if last_duplicates:
+        sample = ", ".join(f"{os.path.basename(img)} ({reason})" for img, reason in last_duplicates[:5])
+        action = "пропущены" if DEDUP_MODE == "skip" else "оставлены в очереди"
+        logging.warning(f"Дубликаты по содержимому: {len(last_duplicates)}, {action}: {sample}")
+    return unique
+
+# ─────────────────────────────────────────────────────────────
+# Работа с очередью/файлами
+# ─────────────────────────────────────────────────────────────
+_materials_lock = asyncio.Lock()
+_queue_checked_gen = None  # storage.generation(), с которым очередь последний раз сверялась
+
+def _wait_generation():
     try:
-        if os.path.exists(image_path):
-            os.remove(image_path)
-            logging.info(f"Удален: {os.path.basename(image_path)}")
-        if os.path.exists(text_path):
-            os.remove(text_path)
-            logging.info(f"Удален: {os.path.basename(text_path)}")
+        return os.stat(pending_folder).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+async def refresh_material_queue():
+    """Сверяет очередь с диском, только если каталог wait изменился с прошлой сверки"""
+    global _queue_checked_gen
+    generation = storage.generation()
+    if generation is not None and generation == _queue_checked_gen:
+        return
+    queue, version = material_pairs, material_pairs.version
+    generation, missing = await storage.missing_pairs(list(queue))
+    # Пока шла проверка, очередь могли изменить — тогда результат уже не актуален
+    if material_pairs is not queue or queue.version != version:
+        return
+    _queue_checked_gen = generation
+    if not missing:
+        return
+    for image_path, text_path in missing:
+        logging.warning(f"Удалена пара: {image_path}, {text_path}")
+        material_pairs.remove(image_path)
+    journal_append({"op": "removed", "image": [_rel_path(img) for img, _ in missing]})
+    # Освободившиеся слоты сразу занимаем; на паузе план пуст и не возобновляется
+    if unplan_images(img for img, _ in missing):
+        top_up_plan()
+    logging.info(f"Очередь обновлена: удалено {len(missing)}, осталось: {len(material_pairs)}")
+
+def collect_material_pairs(move_new: bool = False) -> list:
+    """Сканирование и перенос materials -> wait; выполняется в пуле потоков.
+    move_new — переносить новые материалы, даже если в wait уже есть очередь"""
+    material_pairs = []
 
-        global material_pairs
-        material_pairs = [(img, txt) for img, txt in material_pairs if img != image_path and txt != text_path]
+    # Проверяем папку wait (файлы, которые уже в очереди)
+    for image, text_file in pair_folder(pending_folder):
+        material_pairs.append((os.path.join(pending_folder, image), os.path.join(pending_folder, text_file)))
+
+    # Если в wait пусто — берём из materials
+    if not material_pairs or move_new:
+        moved = []
+        wait_fresh = index_is_fresh(pending_folder)
+        for image, text_file in pair_folder(materials_folder):
+            src_image = os.path.join(materials_folder, image)
+            src_text = os.path.join(materials_folder, text_file)
+            dst_image = os.path.join(pending_folder, image)
+            dst_text = os.path.join(pending_folder, text_file)
+            if os.path.exists(dst_image) or os.path.exists(dst_text):
+                logging.warning(f"Пропущено: {image} уже есть в wait")
+                continue
+            try:
+                shutil.move(src_image, dst_image)
+                shutil.move(src_text, dst_text)
+                material_pairs.append((dst_image, dst_text))
+                moved.extend((image, text_file))
+                logging.info(f"Перемещено: {image} + {text_file}")
+            except Exception as e:
+                logging.error(f"Ошибка перемещения {image}: {e}")
+        if moved:
+            index_update(materials_folder, removed=moved)
+            index_update(pending_folder, added=moved, was_fresh=wait_fresh)
+
+    return material_pairs
+
+async def load_and_move_materials():
+    global material_pairs, _queue_checked_gen
+    async with _materials_lock:
+        logging.info("=== ЗАГРУЗКА МАТЕРИАЛОВ ===")
+        material_pairs = MaterialQueue()
+        pairs = await dedup_pairs(await storage.collect())
+        random.shuffle(pairs)
+        material_pairs = MaterialQueue(pairs)
+        _queue_checked_gen = storage.generation()
+        logging.info(f"Загружено {len(material_pairs)} публикаций.")
+    start_image_optimization()
+
+async def sync_material_queue(move_new: bool = False):
+    """Пересканирует папки и применяет к очереди и плану только разницу, не перемешивая очередь"""
+    global _queue_checked_gen
+    async with _materials_lock:
+        pairs = await storage.collect(move_new)
+        found = {img for img, _ in pairs}
+        added = [(img, txt) for img, txt in pairs if img not in material_pairs]
+        removed = [img for img, _ in material_pairs if img not in found]
+        # Пропущенные дубликаты остаются в wait и при каждой сверке снова отсекаются (по кэшу хэшей)
+        added = await dedup_pairs(added, queued=[(img, txt) for img, txt in material_pairs if img in found])
+        random.shuffle(added)
+
+        if removed:
+            for image_path in removed:
+                material_pairs.remove(image_path)
+            journal_append({"op": "removed", "image": [_rel_path(img) for img in removed]})
+            unplan_images(removed)
+        if added:
+            material_pairs.extend(added)
+            journal_append({"op": "queued", "pairs": [[_rel_path(img), _rel_path(txt)] for img, txt in added]})
+        _queue_checked_gen = storage.generation()
+        top_up_plan()
+        logging.info(f"Очередь синхронизирована: +{len(added)}, -{len(removed)}, всего {len(material_pairs)}")
+    if added:
+        start_image_optimization(added)
+    return added, removed
+
+async def remove_sent_files(image_path, text_path):
+    """Удаляет опубликованные файлы из папки wait"""
+    await remove_sent_files_batch([(image_path, text_path)])
+
+async def remove_sent_files_batch(pairs):
+    """Пакетное удаление: один заход в пул, одна пересборка очереди, одна запись в журнал"""
+    if not pairs:
+        return
+    try:
+        global _queue_checked_gen
+        generation = storage.generation()
+        await record_published(pairs)
+        await storage.remove_pairs(pairs)
+
+        for image_path, _text_path in pairs:
+            material_pairs.remove(image_path)
+        # Пара могла уйти не своей задачей (тестовая отправка) — её слот снимаем, иначе он сработает
+        # на удалённых файлах и оставит dead-letter; опубликованные задачи unplan_images не трогает
+        if unplan_images([image_path for image_path, _ in pairs]):
+            top_up_plan()
+        # Свои удаления не требуют повторной сверки очереди с диском
+        if generation is not None and generation == _queue_checked_gen:
+            _queue_checked_gen = storage.generation()
+        images = [_rel_path(img) for img, _ in pairs]
+        journal_append({"op": "removed", "image": images[0] if len(images) == 1 else images})
 
     except Exception as e:
         logging.error(f"Ошибка удаления: {e}", exc_info=True)
 
 # ─────────────────────────────────────────────────────────────
-# Отправка
+# Оптимизация изображений (в отдельных процессах)
 # ─────────────────────────────────────────────────────────────
-async def send_material_pair(image_path, text_path):
+TELEGRAM_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+TELEGRAM_PHOTO_MAX_DIMENSIONS_SUM = 10000
+SMALL_JPEG_BYTES = 1024 * 1024
+
+_optimize_executor = None
+_optimize_task = None
+_image_checks = None  # rel_path -> (mtime_ns, size) оригиналов, которым вариант не нужен: копия таблицы image_checks
+
+def optimized_path_for(image_path: str) -> str:
+    folder, name = os.path.split(image_path)
+    return os.path.join(folder, OPTIMIZED_SUBDIR, os.path.splitext(name)[0] + ".jpg")
+
+def photo_path_for(image_path: str) -> str:
+    """Готовый оптимизированный вариант, если он свежее оригинала, иначе сам оригинал"""
+    opt_path = optimized_path_for(image_path)
+    try:
+        if os.stat(opt_path).st_mtime_ns >= os.stat(image_path).st_mtime_ns:
+            return opt_path
+    except FileNotFoundError:
+        pass
+    return image_path
+
+def optimize_image_file(src: str, dst: str, max_side: int, quality: int) -> bool:
+    """Выполняется в дочернем процессе. False — оригинал уже подходит как есть"""
+    from PIL import Image, ImageOps
+
+    with Image.open(src) as img:
+        if getattr(img, "is_animated", False):
+            return False
+        width, height = img.size
+        size = os.path.getsize(src)
+        fits = (
+            max(width, height) <= max_side
+            and width + height <= TELEGRAM_PHOTO_MAX_DIMENSIONS_SUM
+            and size <= TELEGRAM_PHOTO_MAX_BYTES
+        )
+        if fits and img.format == "JPEG" and size <= SMALL_JPEG_BYTES:
+            return False
+
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = dst + ".tmp"
+        img.save(tmp, "JPEG", quality=quality, optimize=True, progressive=True)
+    if os.path.getsize(tmp) >= size and fits:
+        os.remove(tmp)
+        return False
+    os.replace(tmp, dst)
+    return True
+
+def _optimize_candidates(images) -> list:
+    """[(path, запись индекса)] для пула: без свежего варианта и без решения «подходит как есть»
+    для этой версии файла; mtime/size — из индекса, без stat"""
+    global _image_checks
+    # Индекс читаем до _db_lock — порядок блокировок как в _cached_hashes
+    entries = [(path, index_entry(path)) for path in images if not path.lower().endswith(".gif")]
+    with _db_lock:
+        if _image_checks is None:
+            rows = get_db().execute("SELECT path, mtime_ns, size FROM image_checks")
+            _image_checks = {path: (mtime_ns, size) for path, mtime_ns, size in rows}
+        unchecked = [
+            (path, meta) for path, meta in entries
+            if meta is None or _image_checks.get(_rel_path(path)) != (meta[2], meta[3])
+        ]
+    return [(path, meta) for path, meta in unchecked if photo_path_for(path) == path]
+
+def _store_image_checks(rows) -> None:
+    with _db_lock:
+        get_db().executemany("INSERT OR REPLACE INTO image_checks (path, mtime_ns, size) VALUES (?, ?, ?)", rows)
+        for path, mtime_ns, size in rows:
+            _image_checks[path] = (mtime_ns, size)
+
+async def optimize_pending_images(pairs, previous=None) -> None:
+    global _optimize_executor
+    if previous is not None:
+        try:
+            await asyncio.wait([previous])  # новые пары — после текущего прохода, не прерывая его
+        except asyncio.CancelledError:
+            previous.cancel()
+            raise
+    candidates = await run_io(_optimize_candidates, [image_path for image_path, _ in pairs])
+    if not candidates:
+        return
+    if _optimize_executor is None:
+        from concurrent.futures import ProcessPoolExecutor  # тянет multiprocessing — только когда нужен
+        _optimize_executor = ProcessPoolExecutor(max_workers=OPTIMIZE_WORKERS)
+    loop = asyncio.get_running_loop()
+    optimized = 0
+    fits = []
+    # В порядке очереди: ближайшие публикации готовы первыми
+    try:
+        for image_path, meta in candidates:
+            try:
+                if await loop.run_in_executor(
+                    _optimize_executor, optimize_image_file, image_path, optimized_path_for(image_path),
+                    OPTIMIZE_MAX_SIDE, OPTIMIZE_QUALITY,
+                ):
+                    optimized += 1
+                    prefetcher.discard(image_path)  # в буфере мог остаться неоптимизированный оригинал
+                elif meta is not None:
+                    fits.append((_rel_path(image_path), meta[2], meta[3]))
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logging.warning(f"Оптимизация {os.path.basename(image_path)} не удалась: {e}")
+    finally:
+        # Решения «вариант не нужен» сохраняем и при отмене прохода — повторно эти файлы не откроются
+        if fits:
+            await run_io(_store_image_checks, fits)
+    if optimized:
+        logging.info(f"Оптимизировано изображений: {optimized}")
+
+def start_image_optimization(pairs=None) -> None:
+    """Фоновая оптимизация: без pairs — вся очередь (предыдущий проход отменяется),
+    иначе только эти пары, следом за текущим проходом"""
+    global _optimize_task
+    if not OPTIMIZE_IMAGES or not storage.local or importlib.util.find_spec("PIL") is None:
+        return
     try:
-        if not os.path.exists(image_path):
-            logging.error(f"Файл не найден: {image_path}")
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    previous = _optimize_task if _optimize_task is not None and not _optimize_task.done() else None
+    if pairs is None:
+        if previous is not None:
+            previous.cancel()
+            previous = None
+        pairs = material_pairs
+    _optimize_task = loop.create_task(optimize_pending_images(list(pairs), previous))
+
+def remove_optimized_variant(image_path: str) -> None:
+    try:
+        os.remove(optimized_path_for(image_path))
+    except FileNotFoundError:
+        pass
+    path = _rel_path(image_path)
+    with _db_lock:
+        get_db().execute("DELETE FROM image_checks WHERE path = ?", (path,))
+        if _image_checks is not None:
+            _image_checks.pop(path, None)
+
+# ─────────────────────────────────────────────────────────────
+# Кэш Telegram file_id (sha256 содержимого -> file_id, LRU)
+# ─────────────────────────────────────────────────────────────
+def file_sha256(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def file_id_cache_get(digest: str):
+    with _db_lock:
+        db = get_db()
+        row = db.execute("SELECT file_id FROM file_ids WHERE sha256 = ?", (digest,)).fetchone()
+        if row:
+            db.execute("UPDATE file_ids SET last_used = ? WHERE sha256 = ?", (time.time(), digest))
+    return row[0] if row else None
+
+def file_id_cache_put(digest: str, file_id: str) -> None:
+    with _db_lock:
+        db = get_db()
+        db.execute(
+            "INSERT OR REPLACE INTO file_ids (sha256, file_id, last_used) VALUES (?, ?, ?)",
+            (digest, file_id, time.time()),
+        )
+        overflow = db.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0] - FILE_ID_CACHE_SIZE
+        if overflow > 0:
+            db.execute(
+                "DELETE FROM file_ids WHERE sha256 IN "
+                "(SELECT sha256 FROM file_ids ORDER BY last_used LIMIT ?)",
+                (overflow,),
+            )
+
+def file_id_cache_forget(digest: str) -> None:
+    with _db_lock:
+        get_db().execute("DELETE FROM file_ids WHERE sha256 = ?", (digest,))
+
+# ─────────────────────────────────────────────────────────────
+# Метрики (текстовый формат Prometheus, без зависимостей)
+# ─────────────────────────────────────────────────────────────
+# На горячем пути — только сложение и bisect по границам корзин; текст собирается при запросе /metrics
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LAG_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 21600)
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values)) + "}"
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = defaultdict(float)
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        self._values[label_values] += amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        if not self.labels and not self._values:
+            lines.append(f"{self.name} 0")
+        for values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {value:g}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)  # последняя — +Inf
+        self._sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sum += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        total = 0
+        for bound, count in zip(self.buckets, self._counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {total}')
+        total += self._counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {total}')
+        lines.append(f"{self.name}_sum {self._sum:g}")
+        lines.append(f"{self.name}_count {total}")
+        return lines
+
+def render_gauge(name: str, help_text: str, value) -> list:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value:g}"]
+
+SEND_SECONDS = Histogram("alnpost_send_photo_seconds", "Длительность вызова send_photo, включая загрузку файла")
+WEBHOOK_SECONDS = Histogram("alnpost_webhook_seconds", "Обработка апдейта вебхука диспетчером и хендлерами")
+WEBHOOK_INGRESS_SECONDS = Histogram("alnpost_webhook_ingress_seconds", "Приём запроса /webhook: разбор и постановка в очередь")
+SCHEDULER_LAG = Histogram("alnpost_scheduler_lag_seconds", "Фактический запуск задачи минус плановый", LAG_BUCKETS)
+SENDS_TOTAL = Counter("alnpost_sends_total", "Успешные отправки в чаты", ("mode",))
+SEND_FAILURES_TOTAL = Counter("alnpost_send_failures_total", "Неудачные отправки в чаты", ("reason",))
+RETRIES_TOTAL = Counter("alnpost_retries_total", "Повторные попытки доставки из outbox")
+PREFETCH_TOTAL = Counter("alnpost_prefetch_total", "Отправки из буфера предзагрузки (hit) и с диска (miss)", ("result",))
+WEBHOOK_UPDATES_TOTAL = Counter("alnpost_webhook_updates_total", "Апдейты вебхука: queued, duplicate, rejected", ("result",))
+
+def failure_reason(error: Exception) -> str:
+    if isinstance(error, TelegramRetryAfter):
+        return "retry_after"
+    if isinstance(error, TelegramForbiddenError):
+        return "forbidden"
+    if isinstance(error, TelegramBadRequest):
+        return "bad_request"
+    return "other"
+
+# ─────────────────────────────────────────────────────────────
+# Лимиты отправки (token bucket: общий + на каждый чат)
+# ─────────────────────────────────────────────────────────────
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, count: int = 1) -> None:
+        """count токенов разом; больше ёмкости — в долг, следующие отправки подождут его погашения"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= count
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class RateLimiter:
+    """Общий лимит бота плюс отдельный лимит и пауза (RetryAfter) для каждого чата"""
+
+    def __init__(self, global_rate: float, per_chat_per_minute: float):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._per_chat_rate = per_chat_per_minute / 60
+        self._chats = {}
+        self._paused_until = {}
+
+    def pause(self, chat_id, seconds: float) -> None:
+        self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0), time.monotonic() + seconds)
+
+    async def acquire(self, chat_id, count: int = 1) -> None:
+        # Пауза одного чата не задерживает остальные
+        while (delay := self._paused_until.get(chat_id, 0) - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self._per_chat_rate, 3)
+        await bucket.acquire(count)
+        await self._global.acquire(count)
+
+rate_limiter = RateLimiter(GLOBAL_SEND_RATE, PER_CHAT_PER_MINUTE)
+
+# ─────────────────────────────────────────────────────────────
+# Предзагрузка ближайших публикаций
+# ─────────────────────────────────────────────────────────────
+def photo_input(photo_ref) -> types.InputFile:
+    """Путь/ключ в хранилище или уже загруженные в память байты"""
+    return photo_ref if isinstance(photo_ref, types.InputFile) else storage.input_file(photo_ref)
+
+def _stat_pair(image_path: str, text_path: str) -> tuple:
+    meta = []
+    for path in (image_path, text_path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            meta.append(None)
+            continue
+        meta.append((st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(meta)
+
+class PrefetchedPair:
+    __slots__ = ("text_path", "caption", "photo", "digest", "size", "meta")
+
+    def __init__(self, text_path, caption, photo, digest, size, meta):
+        self.text_path = text_path
+        self.caption = caption
+        self.photo = photo  # BufferedInputFile или путь, если фото уже есть в кэше file_id
+        self.digest = digest
+        self.size = size
+        self.meta = meta  # (inode, mtime_ns, size) картинки и подписи на момент загрузки
+
+class Prefetcher:
+    """Следующие count публикаций плана заранее в памяти, не больше max_bytes:
+    в момент слота остаётся только сетевой вызов"""
+
+    def __init__(self, count: int, max_bytes: int):
+        self.count = count
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # image_path -> PrefetchedPair, в порядке публикации
+        self._wakeup = None
+        self._task = None
+
+    def wakeup(self) -> None:
+        if self.count <= 0:
             return
-        if not os.path.exists(text_path):
-            logging.error(f"Файл не найден: {text_path}")
+        if self._task is None or self._task.done():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return  # вне event loop — подхватим при следующем изменении плана
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        self._wakeup.set()
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.clear()
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+    def discard(self, image_path: str) -> None:
+        entry = self._entries.pop(image_path, None)
+        if entry is not None:
+            self.size -= entry.size
+            self.wakeup()
+
+    @staticmethod
+    async def _meta(image_path: str, text_path: str):
+        # Локальные файлы сверяем по stat (подмена через rename меняет inode и mtime); объекты S3 неизменяемы по ETag
+        return await run_io(_stat_pair, image_path, text_path) if storage.local else None
+
+    async def take(self, image_path: str, text_path: str):
+        """(подпись, фото, digest) из буфера или None, если пары нет или файлы с тех пор менялись.
+        В момент слота с диска берутся только два stat — содержимое уже в памяти"""
+        entry = self._entries.pop(image_path, None)
+        if entry is not None:
+            self.size -= entry.size
+            self.wakeup()  # освободилось место под следующую
+            if entry.text_path == text_path and entry.meta == await self._meta(image_path, text_path):
+                PREFETCH_TOTAL.inc("hit")
+                return entry.caption, entry.photo, entry.digest
+        PREFETCH_TOTAL.inc("miss")
+        return None
+
+    def _due_pairs(self) -> list:
+        now_ts = time.time()
+        in_album = {image_path for image_path, _, _ in _album_items}
+        due = []
+        for task in scheduled_tasks:
+            if task.published:
+                continue
+            if task.run_ts <= now_ts and (task.job is None or task.job.cancelled) and task.image_path not in in_album:
+                continue  # слот прошёл, а живой job нет — эту пару отправлять не будут
+            due.append((task.image_path, task.text_path))
+            if len(due) >= self.count:
+                break
+        return due
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                await self.refill()
+            except Exception as e:
+                logging.error(f"Ошибка предзагрузки: {e}", exc_info=True)
+
+    async def refill(self) -> None:
+        if not lease_is_valid():
+            self.clear()  # публикует не эта реплика
             return
+        due = self._due_pairs()
+        wanted = {image_path for image_path, _ in due}
+        for image_path in [img for img in self._entries if img not in wanted]:
+            self.size -= self._entries.pop(image_path).size
+
+        entries = OrderedDict()
+        budget = self.max_bytes
+        for image_path, text_path in due:
+            entry = self._entries.get(image_path)
+            if entry is None or entry.meta != await self._meta(image_path, text_path):
+                entry = await self._load(image_path, text_path, budget)
+            if entry is None or entry.size > budget:
+                break  # дальние публикации не вытесняют ближние
+            budget -= entry.size
+            entries[image_path] = entry
+        self._entries = entries
+        self.size = self.max_bytes - budget
+
+    async def _load(self, image_path: str, text_path: str, budget: int):
+        meta = await self._meta(image_path, text_path)
+        if meta is not None and None in meta:
+            return None
+        prepared = await storage.read_pair(image_path, text_path)
+        if prepared is None:
+            return None
+        caption, photo_ref, digest = prepared
+        if len(caption) > CAPTION_MAX_LENGTH:
+            logging.warning(
+                f"Подпись {os.path.basename(text_path)} длиннее {CAPTION_MAX_LENGTH} ({len(caption)}): Telegram её не примет"
+            )
+        if await run_io(file_id_cache_get, digest) is not None:
+            return PrefetchedPair(text_path, caption, photo_ref, digest, 0, meta)
+        if storage.local:
+            size = await run_io(os.path.getsize, photo_ref)
+            if size > budget or size > TELEGRAM_PHOTO_MAX_BYTES:
+                return None  # не влезает в буфер или ещё ждёт оптимизации
+        data = await storage.read_bytes(photo_ref)
+        if len(data) > budget:
+            return None
+        photo = types.BufferedInputFile(data, filename=os.path.basename(photo_ref))
+        return PrefetchedPair(text_path, caption, photo, digest, len(data), meta)
+
+prefetcher = Prefetcher(PREFETCH_COUNT, PREFETCH_MAX_BYTES)
 
-        with open(text_path, 'r', encoding='utf-8') as f:
-            caption = f.read().strip()
+# ─────────────────────────────────────────────────────────────
+# Отправка
+# ─────────────────────────────────────────────────────────────
+async def send_photo_to(chat_id, photo_path: str, digest: str, caption: str) -> bool:
+    """Отправка в один чат с учётом лимитов. True — ушло по кэшированному file_id"""
+    while True:
+        await rate_limiter.acquire(chat_id)
+        # Одинаковое содержимое загружаем в Telegram не больше одного раза
+        file_id = await run_io(file_id_cache_get, digest)
+        started = time.perf_counter()
+        try:
+            sent = await bot.send_photo(
+                chat_id=chat_id,
+                photo=file_id or photo_input(photo_path),
+                caption=caption,
+                disable_notification=True
+            )
+        except TelegramRetryAfter as e:
+            logging.warning(f"Лимит Telegram для {chat_id}: пауза {e.retry_after} сек")
+            rate_limiter.pause(chat_id, e.retry_after)
+            raise
+        except TelegramBadRequest as e:
+            if file_id is None:
+                raise
+            logging.warning(f"file_id отклонён ({e}), загружаем файл заново")
+            await run_io(file_id_cache_forget, digest)
+            continue
+        finally:
+            SEND_SECONDS.observe(time.perf_counter() - started)
+        SENDS_TOTAL.inc("file_id" if file_id else "upload")
+        if file_id is None and sent.photo:
+            await run_io(file_id_cache_put, digest, sent.photo[-1].file_id)
+        return file_id is not None
+
+async def deliver_pair(image_path, text_path, task_idx, chat_ids) -> bool:
+    """Доставляет пару в указанные чаты; неудачи уходят в очередь повторов. True — доставлено всем"""
+    task = find_task(task_idx)
+    chat_ids = [c for c in chat_ids if not (task and c in task.deliveries)]
+    if not chat_ids:
+        return True
+
+    # Из буфера предзагрузки — без диска; иначе читаем, отправляя оптимизированный вариант, если он готов
+    prepared = await prefetcher.take(image_path, text_path) or await storage.read_pair(image_path, text_path)
+    if prepared is None:
+        if task_idx is not None:
+            for chat_id in chat_ids:
+                await outbox_fail(image_path, chat_id, "файл не найден", permanent=True)
+        return False
+    caption, photo_path, digest = prepared
+
+    async def deliver(chat_id):
+        try:
+            cached = await send_photo_to(chat_id, photo_path, digest, caption)
+        except Exception as e:
+            logging.error(f"Ошибка отправки {os.path.basename(image_path)} в {chat_id}: {e}")
+            SEND_FAILURES_TOTAL.inc(failure_reason(e))
+            if task_idx is not None:
+                await outbox_fail(
+                    image_path, chat_id, str(e),
+                    retry_after=getattr(e, "retry_after", None),
+                    permanent=isinstance(e, (TelegramBadRequest, TelegramForbiddenError)),
+                )
+            return False
+        if task_idx is not None:
+            await run_io(outbox_done, [(image_path, chat_id)])
+        if task is not None:
+            task.deliveries.append(chat_id)
+            journal_append({"op": "delivered", "idx": task_idx, "chat": chat_id})
+        logging.info(f"Отправлено: {os.path.basename(image_path)} -> {chat_id}{' (file_id)' if cached else ''}")
+        return True
+
+    # Первая отправка загружает файл, остальные чаты получают его file_id параллельно
+    failed = 0
+    if await run_io(file_id_cache_get, digest) is None:
+        failed += not await deliver(chat_ids[0])
+        chat_ids = chat_ids[1:]
+    results = await asyncio.gather(*(deliver(chat_id) for chat_id in chat_ids))
+    return not failed and all(results)
+
+async def send_material_pair(image_path, text_path, task_idx=None):
+    try:
+        delivered = await deliver_pair(image_path, text_path, task_idx, CHAT_IDS)
+        if task_idx is not None:
+            delivered = not await run_io(outbox_pending, image_path)
+        if delivered:
+            await remove_sent_files(image_path, text_path)
+        else:
+            logging.warning(f"{os.path.basename(image_path)}: доставлено не во все чаты, файлы сохранены")
+    except Exception as e:
+        logging.error(f"Ошибка отправки {image_path}: {e}", exc_info=True)
 
-        await bot.send_photo(
-            chat_id=CHAT_ID,
-            photo=types.FSInputFile(image_path),
-            caption=caption,
-            disable_notification=True
+# ─────────────────────────────────────────────────────────────
+# Альбомы (send_media_group) для пачек догоняющих публикаций
+# ─────────────────────────────────────────────────────────────
+_album_items = []
+_album_flush_job = None
+
+def album_enqueue(image_path, text_path, task_idx) -> None:
+    global _album_flush_job
+    _album_items.append((image_path, text_path, task_idx))
+    if len(_album_items) >= ALBUM_MAX_ITEMS:
+        flush_album()
+    elif _album_flush_job is None:
+        _album_flush_job = scheduler.add(
+            datetime.now(timezone.utc) + timedelta(seconds=ALBUM_WINDOW), flush_album, 'album'
         )
-        logging.info(f"Отправлено: {os.path.basename(image_path)}")
-        remove_sent_files(image_path, text_path)
 
+def flush_album() -> None:
+    global _album_flush_job
+    if _album_flush_job is not None:
+        scheduler.cancel(_album_flush_job)
+        _album_flush_job = None
+    items = _album_items[:]
+    _album_items.clear()
+    if not items:
+        return
+
+    # Флаги публикации — одной пачкой и одной записью в журнале
+    indexes = []
+    for _, _, task_idx in items:
+        task = find_task(task_idx)
+        if task is not None:
+            task.published = True
+            indexes.append(task_idx)
+    if indexes:
+        journal_append({"op": "published", "idx": indexes})
+    asyncio.create_task(send_album(items))
+
+async def send_media_to(chat_id, entries) -> list:
+    """entries: [(caption, photo_path, digest)]; возвращает отправленные сообщения"""
+    if len(entries) == 1:
+        caption, photo_path, digest = entries[0]
+        await send_photo_to(chat_id, photo_path, digest, caption)
+        return []
+    # Каждое фото альбома Telegram считает отдельным сообщением
+    await rate_limiter.acquire(chat_id, len(entries))
+    file_ids = [await run_io(file_id_cache_get, digest) for _, _, digest in entries]
+    media = [
+        types.InputMediaPhoto(media=file_id or photo_input(photo_path), caption=caption)
+        for (caption, photo_path, _), file_id in zip(entries, file_ids)
+    ]
+    try:
+        messages = await bot.send_media_group(chat_id=chat_id, media=media, disable_notification=True)
+    except TelegramRetryAfter as e:
+        logging.warning(f"Лимит Telegram для {chat_id}: пауза {e.retry_after} сек")
+        rate_limiter.pause(chat_id, e.retry_after)
+        raise
+    for (_, _, digest), file_id, sent in zip(entries, file_ids, messages):
+        if file_id is None and sent.photo:
+            await run_io(file_id_cache_put, digest, sent.photo[-1].file_id)
+    return messages
+
+async def send_album(items) -> None:
+    try:
+        prepared = [await prefetcher.take(img, txt) for img, txt, _ in items]
+        missing = [(img, txt) for (img, txt, _), pair in zip(items, prepared) if pair is None]
+        if missing:
+            loaded = iter(await storage.read_pairs(missing))
+            prepared = [pair or next(loaded) for pair in prepared]
+        ready = []
+        for (image_path, text_path, task_idx), pair in zip(items, prepared):
+            if pair is None:
+                for chat_id in CHAT_IDS:
+                    await outbox_fail(image_path, chat_id, "файл не найден", permanent=True)
+                continue
+            ready.append((image_path, text_path, task_idx, *pair))
+
+        async def deliver(chat_id):
+            pending = []
+            for item in ready:
+                task = find_task(item[2])
+                if not (task and chat_id in task.deliveries):
+                    pending.append((item, task))
+            if not pending:
+                return
+            try:
+                await send_media_to(chat_id, [(caption, photo_path, digest) for (*_, caption, photo_path, digest), _ in pending])
+            except Exception as e:
+                logging.error(f"Ошибка альбома в {chat_id}: {e}")
+                SEND_FAILURES_TOTAL.inc(failure_reason(e), amount=len(pending))
+                # Дальше каждая публикация повторяется по отдельности
+                for (image_path, *_), _ in pending:
+                    await outbox_fail(
+                        image_path, chat_id, str(e),
+                        retry_after=getattr(e, "retry_after", None),
+                        permanent=isinstance(e, TelegramForbiddenError),
+                    )
+                return
+            await run_io(outbox_done, [(image_path, chat_id) for (image_path, *_), _ in pending])
+            indexes = []
+            for (_, _, task_idx, *_), task in pending:
+                if task is not None:
+                    task.deliveries.append(chat_id)
+                    indexes.append(task_idx)
+            if indexes:
+                journal_append({"op": "delivered", "idx": indexes, "chat": chat_id})
+            if len(pending) > 1:
+                SENDS_TOTAL.inc("album", amount=len(pending))  # одиночную отправку уже посчитал send_photo_to
+            logging.info(f"Альбом: {len(pending)} публикаций -> {chat_id}")
+
+        # Первый чат загружает файлы, остальные получают готовые file_id
+        if CHAT_IDS:
+            await deliver(CHAT_IDS[0])
+            await asyncio.gather(*(deliver(chat_id) for chat_id in CHAT_IDS[1:]))
+
+        done = [
+            (image_path, text_path) for image_path, text_path, *_ in ready
+            if not await run_io(outbox_pending, image_path)
+        ]
+        await remove_sent_files_batch(done)
     except Exception as e:
-        logging.error(f"Ошибка отправки {image_path}: {e}", exc_info=True)
+        logging.error(f"Ошибка отправки альбома: {e}", exc_info=True)
 
 # ─────────────────────────────────────────────────────────────
-# Планирование
+# Очередь повторов (outbox в SQLite) и dead-letter
 # ─────────────────────────────────────────────────────────────
-def schedule_posts():
-    global scheduled_tasks
-    logging.info("=== ПЛАНИРОВАНИЕ ===")
-    
-    # Очищаем старые задачи
+# Строка в outbox появляется ДО отправки и удаляется после успеха,
+# поэтому публикация не теряется ни при ошибке, ни при падении процесса.
+_retry_slots = None
+
+def retry_delay(attempts: int, retry_after=None) -> float:
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    delay = random.uniform(delay / 2, delay)
+    if retry_after:
+        delay = max(delay, float(retry_after))
+    return delay
+
+def outbox_add(image_path, text_path, task_idx, chat_ids) -> None:
+    now = time.time()
+    with _db_lock:
+        get_db().executemany(
+            "INSERT OR IGNORE INTO outbox (image_path, chat_id, text_path, task_idx, next_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(image_path, str(chat_id), text_path, task_idx, now) for chat_id in chat_ids],
+        )
+
+def outbox_done(deliveries) -> None:
+    """deliveries: [(image_path, chat_id)] — доставлено"""
+    rows = [(image_path, str(chat_id)) for image_path, chat_id in deliveries]
+    with _db_lock:
+        db = get_db()
+        db.executemany("DELETE FROM outbox WHERE image_path = ? AND chat_id = ?", rows)
+        db.executemany("DELETE FROM dead_letters WHERE image_path = ? AND chat_id = ?", rows)
+
+def outbox_pending(image_path) -> int:
+    """Сколько чатов ещё ждут пару (в повторах или в dead-letter) — пока >0, файлы не удаляем"""
+    with _db_lock:
+        db = get_db()
+        return (
+            db.execute("SELECT COUNT(*) FROM outbox WHERE image_path = ?", (image_path,)).fetchone()[0]
+            + db.execute("SELECT COUNT(*) FROM dead_letters WHERE image_path = ?", (image_path,)).fetchone()[0]
+        )
+
+def _outbox_fail(image_path, chat_id: str, error: str, retry_after, permanent: bool):
+    """В пуле: (text_path, task_idx, attempts, next_at) для повтора или None"""
+    with _db_lock:
+        db = get_db()
+        row = db.execute(
+            "SELECT text_path, task_idx, attempts FROM outbox WHERE image_path = ? AND chat_id = ?",
+            (image_path, chat_id),
+        ).fetchone()
+        if row is None:
+            return None
+        text_path, task_idx, attempts = row
+        attempts += 1
+        if permanent or attempts >= RETRY_MAX_ATTEMPTS:
+            db.execute("DELETE FROM outbox WHERE image_path = ? AND chat_id = ?", (image_path, chat_id))
+            db.execute(
+                "INSERT INTO dead_letters (image_path, chat_id, text_path, task_idx, attempts, last_error, failed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (image_path, chat_id, text_path, task_idx, attempts, error, time.time()),
+            )
+            logging.error(f"Dead-letter: {os.path.basename(image_path)} -> {chat_id} после {attempts} попыток: {error}")
+            return None
+        next_at = time.time() + retry_delay(attempts, retry_after)
+        db.execute(
+            "UPDATE outbox SET attempts = ?, next_at = ?, last_error = ? WHERE image_path = ? AND chat_id = ?",
+            (attempts, next_at, error, image_path, chat_id),
+        )
+    return text_path, task_idx, attempts, next_at
+
+async def outbox_fail(image_path, chat_id, error: str, retry_after=None, permanent: bool = False) -> None:
+    chat_id = str(chat_id)
+    retry = await run_io(_outbox_fail, image_path, chat_id, error, retry_after, permanent)
+    if retry is None:
+        return
+    text_path, task_idx, attempts, next_at = retry
+    schedule_retry(image_path, text_path, task_idx, chat_id, next_at)
+    logging.info(f"Повтор {attempts}/{RETRY_MAX_ATTEMPTS}: {os.path.basename(image_path)} -> {chat_id} через {next_at - time.time():.0f} сек")
+
+def outbox_counts() -> tuple:
+    with _db_lock:
+        db = get_db()
+        return (
+            db.execute("SELECT COUNT(*) FROM outbox WHERE attempts > 0").fetchone()[0],
+            db.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0],
+        )
+
+def _outbox_clear() -> None:
+    with _db_lock:
+        get_db().execute("DELETE FROM outbox")
+
+async def outbox_clear() -> None:
+    scheduler.clear('retry')
+    await run_io(_outbox_clear)
+
+async def retry_delivery(image_path, text_path, task_idx, chat_id) -> None:
+    global _retry_slots
+    if _retry_slots is None:
+        _retry_slots = asyncio.Semaphore(RETRY_MAX_IN_FLIGHT)
+    # Ограничиваем число одновременных повторов
+    async with _retry_slots:
+        RETRIES_TOTAL.inc()
+        try:
+            await deliver_pair(image_path, text_path, task_idx, [chat_id])
+            if not await run_io(outbox_pending, image_path):
+                await remove_sent_files(image_path, text_path)
+        except Exception as e:
+            logging.error(f"Ошибка повтора {image_path}: {e}", exc_info=True)
+
+def schedule_retry(image_path, text_path, task_idx, chat_id, next_at: float) -> None:
+    def job_func():
+        asyncio.create_task(retry_delivery(image_path, text_path, task_idx, chat_id))
+    scheduler.add(datetime.fromtimestamp(next_at, tz=timezone.utc), job_func, 'retry')
+
+def restore_retries() -> int:
+    """После рестарта ставит в планировщик все незавершённые отправки"""
+    with _db_lock:
+        rows = get_db().execute(
+            "SELECT image_path, text_path, task_idx, chat_id, next_at FROM outbox"
+        ).fetchall()
+    for image_path, text_path, task_idx, chat_id, next_at in rows:
+        schedule_retry(image_path, text_path, task_idx, chat_id, next_at)
+    if rows:
+        logging.info(f"Восстановлено незавершённых отправок: {len(rows)}")
+    return len(rows)
+
+# ─────────────────────────────────────────────────────────────
+# Планировщик (min-heap по UTC-дедлайнам)
+# ─────────────────────────────────────────────────────────────
+SCHEDULER_MAX_SLEEP = 300  # страховка от скачков системных часов/сна хоста, сек
+
+class Job:
+    __slots__ = ("run_at", "callback", "tags", "cancelled", "held")
+
+    def __init__(self, run_at: float, callback, tags):
+        self.run_at = run_at  # UTC epoch
+        self.callback = callback
+        self.tags = tags
+        self.cancelled = False
+        self.held = False  # вынута из кучи и ждёт в догоняющей очереди
+
+    @property
+    def run_dt_utc(self) -> datetime:
+        return datetime.fromtimestamp(self.run_at, tz=timezone.utc)
+
+class Scheduler:
+    """Одноразовые задачи в min-heap: вставка O(log n), отмена O(1) с ленивым удалением из кучи"""
+
+    def __init__(self, catchup_grace: float = None, on_missed=None, catchup_tags=(), gate=None, gate_poll: float = 1.0):
+        self._heap = []  # (run_at, seq, job)
+        self._seq = itertools.count()
+        self._by_tag = defaultdict(set)
+        self._cancelled = 0
+        self._held = 0
+        self._wakeup = None
+        # Сильно опоздавшие задачи с этими тегами отдаются on_missed вместо немедленного запуска
+        self.catchup_grace = catchup_grace
+        self.on_missed = on_missed
+        self.catchup_tags = frozenset(catchup_tags)
+        # Пока gate() ложно, задачи не запускаются (реплика потеряла право публиковать)
+        self.gate = gate
+        self.gate_poll = gate_poll  # как часто перепроверять закрытый gate (иначе просроченная голова кучи — цикл без сна)
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled + self._held
+
+    def add(self, run_at: datetime, callback, *tags) -> Job:
+        if run_at.tzinfo is None:
+            raise ValueError("Время задачи должно быть с часовым поясом")
+        job = Job(run_at.timestamp(), callback, tags)
+        is_earliest = not self._heap or job.run_at < self._heap[0][0]
+        heapq.heappush(self._heap, (job.run_at, next(self._seq), job))
+        for tag in tags:
+            self._by_tag[tag].add(job)
+        if is_earliest and self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    def _forget(self, job: Job) -> None:
+        for tag in job.tags:
+            jobs = self._by_tag.get(tag)
+            if jobs is not None:
+                jobs.discard(job)
+                if not jobs:
+                    del self._by_tag[tag]
+
+    def cancel(self, job: Job) -> None:
+        if job.cancelled:
+            return
+        job.cancelled = True
+        self._forget(job)
+        if job.held:
+            job.held = False
+            self._held -= 1
+            return
+        self._cancelled += 1
+        # Когда отменённых больше половины — пересобираем кучу, амортизированно O(1)
+        if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+            self._heap = [item for item in self._heap if not item[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def clear(self, tag: str) -> int:
+        jobs = self._by_tag.pop(tag, ())
+        for job in list(jobs):
+            self.cancel(job)
+        return len(jobs)
+
+    def count(self, tag: str) -> int:
+        return len(self._by_tag.get(tag, ()))
+
+    def _drop_cancelled_head(self) -> None:
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+    def next_run(self):
+        self._drop_cancelled_head()
+        return self._heap[0][2].run_dt_utc if self._heap else None
+
+    def release(self, job: Job) -> bool:
+        """Снимает удержанную задачу перед запуском; False — её уже отменили"""
+        if job.cancelled:
+            return False
+        job.cancelled = True
+        job.held = False
+        self._held -= 1
+        self._forget(job)
+        return True
+
+    def wakeup(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def run_pending(self) -> int:
+        if self.gate is not None and not self.gate():
+            return 0
+        now = time.time()
+        ran = 0
+        missed = []
+        while True:
+            self._drop_cancelled_head()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            _, _, job = heapq.heappop(self._heap)
+            if (
+                self.on_missed is not None
+                and job.run_at < now - self.catchup_grace
+                and not self.catchup_tags.isdisjoint(job.tags)
+            ):
+                job.held = True
+                self._held += 1
+                missed.append(job)
+                continue
+            job.cancelled = True  # одноразовая
+            self._forget(job)
+            SCHEDULER_LAG.observe(now - job.run_at)
+            try:
+                job.callback()
+            except Exception as e:
+                logging.error(f"Ошибка задачи {job.tags}: {e}", exc_info=True)
+            ran += 1
+        if missed:
+            self.on_missed(missed)
+        return ran
+
+    async def run_forever(self) -> None:
+        self._wakeup = asyncio.Event()
+        while True:
+            self.run_pending()
+            self._wakeup.clear()
+            self._drop_cancelled_head()
+            delay = SCHEDULER_MAX_SLEEP
+            if self.gate is not None and not self.gate():
+                delay = min(delay, self.gate_poll)
+            elif self._heap:
+                delay = min(delay, max(0.0, self._heap[0][0] - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+scheduler = Scheduler(
+    CATCHUP_GRACE, lambda jobs: handle_missed_jobs(jobs), ('post',), lambda: lease_is_valid(), LEASE_RENEW_INTERVAL,
+)
+
+# ─────────────────────────────────────────────────────────────
+# Догоняющие публикации (после сна/рестарта инстанса)
+# ─────────────────────────────────────────────────────────────
+_catchup_queue = None
+_catchup_workers = []
+
+def _task_for_job(job: Job):
+    for tag in job.tags:
+        if tag.startswith("idx-"):
+            return find_task(int(tag[4:]))
+    return None
+
+def handle_missed_jobs(jobs) -> None:
+    now = time.time()
+    jobs.sort(key=lambda j: j.run_at)
+    logging.info(f"Пропущено публикаций: {len(jobs)}, политика: {CATCHUP_POLICY}")
+
+    if CATCHUP_POLICY == "skip":
+        fresh = []
+        skipped = []
+        for job in jobs:
+            if now - job.run_at <= CATCHUP_MAX_AGE:
+                fresh.append(job)
+            elif scheduler.release(job):
+                logging.info(f"Пропущена устаревшая публикация {job.tags} ({job.run_dt_utc:%d.%m %H:%M} UTC)")
+                task = _task_for_job(job)
+                if task is not None and task.job is job:
+                    skipped.append(task.image_path)
+        if skipped:
+            # Пропускается слот, а не пара: задачу снимаем с плана (с записью в журнал),
+            # пара остаётся в очереди и получает следующий свободный слот
+            unplan_images(skipped)
+            top_up_plan()
+        jobs = fresh
+
+    if CATCHUP_POLICY == "spread":
+        # Равномерно растягиваем пропущенное на окно, начиная с текущего момента
+        step = CATCHUP_SPREAD_WINDOW / len(jobs)
+        for i, job in enumerate(jobs):
+            if scheduler.release(job):
+                new_job = scheduler.add(datetime.fromtimestamp(now + i * step, tz=timezone.utc), job.callback, *job.tags)
+                # Задача плана должна ссылаться на новую job, иначе unplan/retime её не отменят
+                task = _task_for_job(job)
+                if task is not None and task.job is job:
+                    task.job = new_job
+        return
+
+    global _catchup_queue
+    if _catchup_queue is None:
+        _catchup_queue = asyncio.Queue()
+    for job in jobs:
+        _catchup_queue.put_nowait(job)
+    while len(_catchup_workers) < CATCHUP_CONCURRENCY:
+        _catchup_workers.append(asyncio.create_task(catchup_worker()))
+
+async def catchup_worker() -> None:
+    while True:
+        job = await _catchup_queue.get()
+        if not scheduler.release(job):
+            continue
+        if not lease_is_valid():
+            continue  # ведущий её переподнимет из журнала
+        SCHEDULER_LAG.observe(time.time() - job.run_at)
+        try:
+            result = job.callback()
+            # Ждём саму отправку, чтобы одновременно шло не больше CATCHUP_CONCURRENCY
+            if asyncio.isfuture(result):
+                await result
+        except Exception as e:
+            logging.error(f"Ошибка догоняющей публикации {job.tags}: {e}", exc_info=True)
+        await asyncio.sleep(CATCHUP_INTERVAL)
+
+def catchup_backlog() -> int:
+    return _catchup_queue.qsize() if _catchup_queue is not None else 0
+
+# ─────────────────────────────────────────────────────────────
+# Журнал плана (write-ahead, с периодическим сжатием)
+# ─────────────────────────────────────────────────────────────
+# Первая запись — снимок (частота, очередь, задачи горизонта, курсор слотов), дальше — изменения:
+#   {"op": "planned", "tasks": [...], "cursor": [...], "next_idx": N, "free": [...]} (+ "freq" при смене частоты),
+#   {"op": "queued", "pairs": [[img, txt]]}, {"op": "unplanned", "idx": [...], "free": [...]},
+#   {"op": "paused", "value": bool},
+#   {"op": "published", "idx": N}, {"op": "delivered", "idx": N, "chat": id},
+#   {"op": "removed", "image": path}; для пакетных операций idx/image — списки
+_journal_file = None  # открыт и пишется только в потоке журнала
+_journal_records = 0
+# Один поток на журнал: записи ложатся в порядке вызова, event loop не ждёт ни json снимка, ни fsync
+_journal_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+# Групповая запись: строки, накопленные пока поток журнала занят прошлым fsync, уходят одним write+fsync
+_journal_batch = None  # текущая открытая пачка строк; её задача уже стоит в очереди потока
+_journal_batch_lock = threading.Lock()
+_BASE_PREFIX = os.path.join(base_path, "")
+
+def _rel_path(path: str) -> str:
+    # Почти все пути лежат под base_path — обходимся срезом вместо os.path.relpath
+    if path.startswith(_BASE_PREFIX):
+        return path[len(_BASE_PREFIX):]
+    return os.path.relpath(path, base_path)
+
+def _abs_path(path: str) -> str:
+    return os.path.join(base_path, path)
+
+def _plan_snapshot() -> dict:
+    """Снимок плана с абсолютными путями: на loop только копии, пути переводятся в потоке журнала"""
+    return {
+        "op": "snapshot",
+        "freq": PUBLICATIONS_PER_DAY,
+        "queue": list(material_pairs),
+        "tasks": [task.to_record() for task in scheduled_tasks],
+        "planned": list(_planned_images),
+        "cursor": _cursor_record(_slot_cursor),
+        "next_idx": _next_task_idx,
+        "free": sorted(_free_slots),
+        "paused": plan_paused,
+    }
+
+def _journal_close() -> None:
+    global _journal_file
+    if _journal_file is not None:
+        _journal_file.close()
+        _journal_file = None
+
+def _journal_write_snapshot(snapshot: dict) -> None:
+    """В потоке журнала: снимок во временный файл, затем атомарно через os.replace"""
+    snapshot["queue"] = [[_rel_path(img), _rel_path(txt)] for img, txt in snapshot["queue"]]
+    snapshot["planned"] = [_rel_path(img) for img in snapshot["planned"]]
+    tmp_path = JOURNAL_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(snapshot, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        _journal_close()
+        os.replace(tmp_path, JOURNAL_PATH)
+    except Exception as e:
+        logging.error(f"Ошибка записи журнала: {e}", exc_info=True)
+
+def _journal_write_lines(lines) -> None:
+    global _journal_file
     try:
-        schedule.clear('post')
-        schedule.clear('test')  # Также очищаем тестовые задачи
+        if _journal_file is None:
+            _journal_file = open(JOURNAL_PATH, "a", encoding="utf-8")
+        _journal_file.write("".join(lines))
+        _journal_file.flush()
+        os.fsync(_journal_file.fileno())
     except Exception as e:
-        logging.warning(f"Ошибка очистки: {e}")
+        logging.error(f"Ошибка записи журнала: {e}", exc_info=True)
+
+def _journal_write_batch(batch: list) -> None:
+    global _journal_batch
+    with _journal_batch_lock:
+        if _journal_batch is batch:
+            _journal_batch = None  # дальше строки копятся в новую пачку
+    _journal_write_lines(batch)
+
+async def run_journal(func, *args):
+    """Выполняет func в потоке журнала — после всех уже поставленных записей"""
+    return await asyncio.get_running_loop().run_in_executor(_journal_executor, func, *args)
+
+def journal_compact() -> None:
+    """Переписывает журнал одним снимком текущего плана. Снимок собирается здесь же (он должен
+    совпасть с планом на момент вызова), сериализация и запись — в потоке журнала"""
+    global _journal_records, _journal_batch
+    if not lease_is_valid():
+        return
+    with _journal_batch_lock:
+        # Открытая пачка допишется в старый файл до снимка; новые строки — только после него
+        _journal_batch = None
+    _journal_executor.submit(_journal_write_snapshot, _plan_snapshot())
+    _journal_records = 0
+
+def journal_append(record: dict) -> None:
+    global _journal_records, _journal_batch
+    if not lease_is_valid():
+        return  # журнал общий: пишет только ведущий
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _journal_batch_lock:
+        if _journal_batch is None:
+            _journal_batch = []
+            _journal_executor.submit(_journal_write_batch, _journal_batch)
+        _journal_batch.append(line)
+    _journal_records += 1
+    if _journal_records >= JOURNAL_COMPACT_EVERY:
+        journal_compact()
+
+def _as_list(value) -> list:
+    return value if isinstance(value, list) else [value]
+
+def journal_replay():
+    """Восстанавливает план из журнала; оборванная последняя запись игнорируется"""
+    try:
+        f = open(JOURNAL_PATH, "r", encoding="utf-8")
+    except FileNotFoundError:
+        return None
 
+    state = None
+    with f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning("Журнал: повреждённая запись, остальное пропущено")
+                break
+            op = record.get("op")
+            if op == "snapshot":
+                state = {
+                    "freq": record["freq"],
+                    "queue": {img: txt for img, txt in record["queue"]},
+                    "tasks": {task[1]: task for task in record["tasks"]},
+                    "planned": set(record["planned"]),
+                    "cursor": record["cursor"],
+                    "next_idx": record["next_idx"],
+                    "free": record.get("free", []),
+                    "paused": record.get("paused", False),
+                }
+            elif state is None:
+                continue
+            elif op == "planned":
+                for task in record["tasks"]:
+                    state["tasks"][task[1]] = task
+                    state["planned"].add(task[2])
+                state["cursor"] = record["cursor"]
+                state["next_idx"] = record["next_idx"]
+                state["free"] = record.get("free", [])
+                if "freq" in record:
+                    state["freq"] = record["freq"]
+            elif op == "paused":
+                state["paused"] = record["value"]
+            elif op == "queued":
+                for img, txt in record["pairs"]:
+                    state["queue"][img] = txt
+            elif op == "unplanned":
+                for idx in record["idx"]:
+                    state["tasks"].pop(idx, None)
+                state["free"] = record["free"]
+            elif op == "published":
+                for idx in _as_list(record["idx"]):
+                    task = state["tasks"].get(idx)
+                    if task is not None:
+                        task[4] = True
+            elif op == "delivered":
+                for idx in _as_list(record["idx"]):
+                    task = state["tasks"].get(idx)
+                    if task is not None and record["chat"] not in task[5]:
+                        task[5].append(record["chat"])
+            elif op == "removed":
+                for image in _as_list(record["image"]):
+                    state["queue"].pop(image, None)
+                    state["planned"].discard(image)
+    return state
+
+def journal_load():
+    """journal_replay с абсолютными путями очереди — для run_journal, чтобы перевод путей шёл не на loop"""
+    state = journal_replay()
+    if state:
+        state["queue"] = [(_abs_path(img), _abs_path(txt)) for img, txt in state["queue"].items()]
+        state["planned"] = [_abs_path(img) for img in state["planned"]]
+    return state
+
+async def restore_plan(mirror: bool = False) -> bool:
+    """Тёплый старт: очередь и задачи из журнала, без пересканирования и перемешивания.
+    mirror — копия плана на ведомой реплике: ничего не дописываем и не сжимаем"""
+    global material_pairs, PUBLICATIONS_PER_DAY, _slot_cursor, _next_task_idx, _queue_checked_gen, plan_paused
+    try:
+        state = await run_journal(journal_load)
+    except Exception as e:
+        logging.error(f"Журнал не прочитан, полная загрузка: {e}", exc_info=True)
+        return False
+    if not state or not state["queue"]:
+        return False
+
+    PUBLICATIONS_PER_DAY = state["freq"]
+    plan_paused = state["paused"]
+    material_pairs = MaterialQueue(state["queue"])
+    _queue_checked_gen = None  # с диском очередь из журнала ещё не сверялась
+
+    scheduler.clear('post')
+    reset_plan()
+    _planned_images.update(state["planned"])
+    _slot_cursor = _cursor_from_record(state["cursor"])
+    _next_task_idx = state["next_idx"]
+    _free_slots.extend(state["free"])
+    heapq.heapify(_free_slots)
+    for record in sorted(state["tasks"].values()):
+        arm_task(PlannedTask.from_record(record))
+    if mirror:
+        return True
+    top_up_plan()
+
+    # Сразу сжимаем: хвост журнала после сбоя не должен мешать новым записям
+    journal_compact()
+    start_image_optimization()
+    logging.info(
+        f"План восстановлен из журнала: очередь {len(material_pairs)}, "
+        f"задач {scheduler.count('post')}, частота {PUBLICATIONS_PER_DAY}"
+    )
+    return True
+
+def create_post_job(img_path, txt_path, task_idx):
+    async def publish(album: bool):
+        # Сначала фиксируем отправку в outbox (в пуле, loop не ждёт базу), потом отправляем
+        await run_io(outbox_add, img_path, txt_path, task_idx, CHAT_IDS)
+        if album:
+            album_enqueue(img_path, txt_path, task_idx)
+            return
+        # В журнал — только после outbox: иначе сбой между ними потерял бы публикацию
+        journal_append({"op": "published", "idx": task_idx})
+        await send_material_pair(img_path, txt_path, task_idx)
+
+    def job_func():
+        album = ALBUM_WINDOW > 0
+        if not album:
+            # В памяти помечаем сразу: слот израсходован, а пара остаётся в буфере предзагрузки
+            task = find_task(task_idx)
+            if task is not None:
+                task.published = True
+                logging.info(f"Помечена как опубликованная задача {task_idx}")
+        send_task = asyncio.create_task(publish(album))
+        # Слот израсходован — продлеваем горизонт
+        top_up_plan()
+        return send_task
+    return job_func
+
+# ─────────────────────────────────────────────────────────────
+# Планирование (скользящий горизонт)
+# ─────────────────────────────────────────────────────────────
+class PlannedTask:
+    __slots__ = ("run_ts", "idx", "image_path", "text_path", "published", "deliveries", "job")
+
+    def __init__(self, run_ts: float, idx: int, image_path: str, text_path: str, published=False, deliveries=None):
+        self.run_ts = run_ts  # UTC epoch
+        self.idx = idx
+        self.image_path = image_path
+        self.text_path = text_path
+        self.published = published
+        self.deliveries = deliveries if deliveries is not None else []
+        self.job = None
+
+    @property
+    def run_dt_utc(self) -> datetime:
+        return datetime.fromtimestamp(self.run_ts, tz=timezone.utc)
+
+    def to_record(self) -> list:
+        # Копия deliveries: запись сериализуется в потоке журнала, пока список может пополняться
+        return [self.run_ts, self.idx, _rel_path(self.image_path), _rel_path(self.text_path), self.published, list(self.deliveries)]
+
+    @classmethod
+    def from_record(cls, record) -> "PlannedTask":
+        run_ts, idx, img, txt, published, deliveries = record
+        return cls(run_ts, idx, _abs_path(img), _abs_path(txt), published, deliveries)
+
+_tasks_by_idx = {}
+_tasks_by_image = {}
+_planned_images = set()  # пары, уже получившие слот (в т.ч. опубликованные, но ещё не удалённые)
+_free_slots = []  # min-heap времён (UTC epoch), освобождённых снятыми с плана парами
+_slot_cursor = None  # (дата, номер окна) следующего слота; None — начать с сегодняшнего дня
+_next_task_idx = 0
+plan_paused = False  # на паузе план не продлевается, даже если в очередь пришли новые пары
+
+def plan_changed() -> None:
+    """Состав или время задач изменились: сбрасываем кэш страниц расписания, будим предзагрузку"""
+    _schedule_page_cache.clear()
+    prefetcher.wakeup()
+
+def _cursor_record(cursor):
+    return [cursor[0].isoformat(), cursor[1]] if cursor else None
+
+def _cursor_from_record(record):
+    return (datetime.fromisoformat(record[0]).date(), record[1]) if record else None
+
+def iter_slots(cursor, freq: int):
+    """Ленивый бесконечный генератор будущих слотов: (run_local, курсор следующего слота)"""
+    date, window = cursor
+    windows = day_windows(freq)[:freq]
+    now_local = get_current_time()
+    while True:
+        if window >= len(windows):
+            date += timedelta(days=1)
+            window = 0
+        h1, h2, _label = windows[window]
+        window += 1
+        run_local = datetime(
+            date.year, date.month, date.day, random.randint(h1, h2), random.randint(0, 59), tzinfo=TZ_LOCAL
+        )
+        if run_local > now_local:
+            yield run_local, (date, window)
+
+def find_task(task_idx):
+    if task_idx is None:
+        return None
+    return _tasks_by_idx.get(task_idx)
+
+def reset_plan() -> None:
+    global _slot_cursor
     scheduled_tasks.clear()
+    _tasks_by_idx.clear()
+    _tasks_by_image.clear()
+    _planned_images.clear()
+    _free_slots.clear()
+    _slot_cursor = None
+    plan_changed()
+
+def _task_sort_key(task: PlannedTask) -> float:
+    return task.run_ts
+
+def _arm_job(task: PlannedTask) -> None:
+    task.job = scheduler.add(
+        task.run_dt_utc, create_post_job(task.image_path, task.text_path, task.idx), 'post', f'idx-{task.idx}'
+    )
+
+def arm_task(task: PlannedTask) -> None:
+    bisect.insort(scheduled_tasks, task, key=_task_sort_key)
+    plan_changed()
+    _tasks_by_idx[task.idx] = task
+    _tasks_by_image[task.image_path] = task
+    _planned_images.add(task.image_path)
+    if not task.published:
+        _arm_job(task)
+
+def _drop_task(task: PlannedTask) -> None:
+    pos = bisect.bisect_left(scheduled_tasks, task.run_ts, key=_task_sort_key)
+    while scheduled_tasks[pos] is not task:
+        pos += 1
+    del scheduled_tasks[pos]
+    plan_changed()
+    _tasks_by_idx.pop(task.idx, None)
+    if _tasks_by_image.get(task.image_path) is task:
+        del _tasks_by_image[task.image_path]
+
+def set_plan_paused(paused: bool) -> None:
+    global plan_paused
+    if plan_paused != paused:
+        plan_paused = paused
+        journal_append({"op": "paused", "value": paused})
+
+def _take_free_slot(now_ts: float):
+    while _free_slots and _free_slots[0] <= now_ts:
+        heapq.heappop(_free_slots)
+    return heapq.heappop(_free_slots) if _free_slots else None
+
+def _extend_plan() -> list:
+    """Досоздаёт задачи до горизонта PLAN_HORIZON_DAYS: память и время O(горизонт), а не O(очередь)"""
+    global _slot_cursor, _next_task_idx
+    if plan_paused:
+        return []
+    now_ts = time.time()
+
+    # Прошедшие опубликованные задачи в плане больше не нужны
+    done = 0
+    while done < len(scheduled_tasks) and scheduled_tasks[done].published and scheduled_tasks[done].run_ts <= now_ts:
+        task = scheduled_tasks[done]
+        _tasks_by_idx.pop(task.idx, None)
+        if _tasks_by_image.get(task.image_path) is task:
+            del _tasks_by_image[task.image_path]
+        done += 1
+    if done:
+        del scheduled_tasks[:done]
+        plan_changed()
+
+    if _slot_cursor is None:
+        _slot_cursor = (get_current_time().date(), 0)
+    horizon_ts = now_ts + PLAN_HORIZON_DAYS * 86400
+    slots = iter_slots(_slot_cursor, PUBLICATIONS_PER_DAY)
+    # Спланированные пары стоят в начале очереди, так что проход короткий
+    unplanned = ((img, txt) for img, txt in material_pairs if img not in _planned_images)
+
+    added = []
+    for image_path, text_path in unplanned:
+        # Сначала занимаем освободившиеся слоты, потом берём новые у генератора
+        run_ts = _take_free_slot(now_ts)
+        if run_ts is None:
+            run_local, cursor = next(slots)
+            if run_local.timestamp() > horizon_ts:
+                break
+            _slot_cursor = cursor
+            run_ts = run_local.timestamp()
+        task = PlannedTask(run_ts, _next_task_idx, image_path, text_path)
+        _next_task_idx += 1
+        arm_task(task)
+        added.append(task)
+        logging.info(
+            "План: local=%s | utc=%s",
+            task.run_dt_utc.astimezone(TZ_LOCAL).strftime("%Y-%m-%d %H:%M %Z"),
+            task.run_dt_utc.strftime("%Y-%m-%d %H:%M %Z"),
+        )
+    return added
+
+def _journal_planned(tasks: list, **extra) -> None:
+    journal_append({
+        "op": "planned",
+        "tasks": [task.to_record() for task in tasks],
+        "cursor": _cursor_record(_slot_cursor),
+        "next_idx": _next_task_idx,
+        "free": sorted(_free_slots),
+        **extra,
+    })
+
+def top_up_plan(journal: bool = True) -> int:
+    added = _extend_plan()
+    if added and journal:
+        _journal_planned(added)
+    return len(added)
+
+def unplan_images(images) -> list:
+    """Снимает с плана пропавшие пары; их будущие слоты достанутся следующим парам очереди"""
+    now_ts = time.time()
+    freed = []
+    for image_path in images:
+        _planned_images.discard(image_path)
+        task = _tasks_by_image.get(image_path)
+        if task is None or task.published:
+            continue
+        if task.job is not None:
+            scheduler.cancel(task.job)
+        _drop_task(task)
+        if task.run_ts > now_ts:
+            heapq.heappush(_free_slots, task.run_ts)
+        freed.append(task.idx)
+    if freed:
+        journal_append({"op": "unplanned", "idx": freed, "free": sorted(_free_slots)})
+        logging.info(f"Снято с плана: {len(freed)} задач, свободных слотов: {len(_free_slots)}")
+    return freed
+
+def retime_plan() -> int:
+    """Смена частоты: будущим неопубликованным задачам — новые слоты, порядок и состав плана сохраняются"""
+    global _slot_cursor
+    now_ts = time.time()
+    pending = [task for task in scheduled_tasks if not task.published and task.run_ts > now_ts]
+
+    _free_slots.clear()
+    cursor = (get_current_time().date(), 0)
+    slots = iter_slots(cursor, PUBLICATIONS_PER_DAY)
+    for task in pending:
+        run_local, cursor = next(slots)
+        task.run_ts = run_local.timestamp()
+        if task.job is not None:
+            scheduler.cancel(task.job)
+        _arm_job(task)
+    _slot_cursor = cursor
+    scheduled_tasks.sort(key=_task_sort_key)
+    plan_changed()
+
+    # При росте частоты горизонт вмещает больше задач — досоздаём
+    added = _extend_plan()
+    _journal_planned(pending + added, freq=PUBLICATIONS_PER_DAY)
+    logging.info(f"Частота {PUBLICATIONS_PER_DAY}: перенесено {len(pending)} задач, добавлено {len(added)}")
+    return len(pending) + len(added)
+
+def schedule_posts():
+    global plan_paused
+    logging.info("=== ПЛАНИРОВАНИЕ ===")
+    plan_paused = False  # журнал сожмётся ниже вместе с флагом
+
+    # Очищаем старые задачи
+    scheduler.clear('post')
+    scheduler.clear('test')  # Также очищаем тестовые задачи
+    reset_plan()
 
     if not material_pairs:
+        journal_compact()
         logging.info("Нет публикаций")
         return
 
@@ -224,134 +2763,519 @@ def schedule_posts():
     logging.info("Server TZ: %s, now=%s", SERVER_TZ, datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S %Z"))
     logging.info("User   TZ: %s, now=%s", TZ_LOCAL, datetime.now(TZ_LOCAL).strftime("%Y-%m-%d %H:%M:%S %Z"))
 
-    now_local = get_current_time()
-    anchor_date = now_local.date()
-
-    def day_windows(freq: int):
-        if freq <= 1:
-            return [(9, 11, "утро")]  # 9-11 утра
-        if freq == 2:
-            return [(8, 11, "утро"), (18, 21, "вечер")]  # Утро и вечер
-        if freq == 3:
-            return [(8, 11, "утро"), (12, 17, "день"), (18, 21, "вечер")]
-        return [(8, 10, "раннее утро"), (11, 13, "полдень"), (14, 17, "день"), (18, 21, "вечер")]
-
-    windows = day_windows(PUBLICATIONS_PER_DAY)
-
-    def build_future_slots(min_count: int):
-        slots = []
-        days_to_build = max(3, math.ceil(min_count / max(1, PUBLICATIONS_PER_DAY)) + 3)
-        d = 0
-        while len(slots) < min_count:
-            date = anchor_date + timedelta(days=d)
-            for (h1, h2, label) in windows[:PUBLICATIONS_PER_DAY]:
-                hh, mm = map(int, random_time(h1, h2).split(":"))
-                run_local = datetime(date.year, date.month, date.day, hh, mm, tzinfo=TZ_LOCAL)
-                if run_local > now_local:
-                    slots.append((run_local, label))
-            d += 1
-            if d >= days_to_build and len(slots) < min_count:
-                days_to_build += 3
-        slots.sort(key=lambda x: x[0])
-        return slots
-
-    needed = len(material_pairs)
-    future_slots = build_future_slots(needed)
-
-    planned_count = 0
-    
-    for idx, (run_local, period_label) in enumerate(future_slots[:needed]):
-        try:
-            # Преобразуем в локальное время сервера (schedule ждёт наивное "локальное")
-            run_server = run_local.astimezone(SERVER_TZ)
-            
-            # Готовим задачу как одноразовую
-            image_path, text_path = material_pairs[idx]
-            
-            def create_job(img_path, txt_path, task_idx):
-                def job_func():
-                    asyncio.create_task(send_material_pair(img_path, txt_path))
-                    # Помечаем задачу как опубликованную
-                    for task in scheduled_tasks:
-                        if task["material_index"] == task_idx:
-                            task["published"] = True
-                            logging.info(f"Помечена как опубликованная задача {task_idx}")
-                            break
-                    return schedule.CancelJob
-                return job_func
-
-            job = schedule.every().day.do(
-                create_job(image_path, text_path, idx)
-            ).tag('post', f'idx-{idx}')
-
-            # Абсолютный момент старта в локальном времени сервера (наивный)
-            job.next_run = run_server.replace(tzinfo=None)
-
-            # Для UI и логов сохраняем UTC
-            run_utc = run_server.astimezone(timezone.utc)
-            scheduled_tasks.append({
-                "run_dt_utc": run_utc,
-                "note": describe_part_of_day(run_local),
-                "material_index": idx,
-                "published": False
-            })
-
-            logging.info(
-                "План: local=%s | server=%s | utc=%s",
-                run_local.strftime("%Y-%m-%d %H:%M %Z"),
-                run_server.strftime("%Y-%m-%d %H:%M %Z"),
-                run_utc.strftime("%Y-%m-%d %H:%M %Z"),
-            )
-            planned_count += 1
-
-        except Exception as e:
-            logging.exception(f"Ошибка {idx+1}: {e}")
-
-    scheduled_tasks.sort(key=lambda x: x["run_dt_utc"])
-    logging.info(f"Запланировано {planned_count} публикаций")
+    planned_count = top_up_plan(journal=False)
+    journal_compact()
+    logging.info(f"Запланировано {planned_count} публикаций (горизонт {PLAN_HORIZON_DAYS:g} дн., в очереди {len(material_pairs)})")
 
 # ─────────────────────────────────────────────────────────────
 # Отображение запланированных
 # ─────────────────────────────────────────────────────────────
-def get_scheduled_publications_info(limit: int = 50) -> list[str]:
-    now_local = get_current_time()
-    lines = []
-
-    shown_count = 0
-    for item in sorted(scheduled_tasks, key=lambda x: x["run_dt_utc"]):
-        run_local = item["run_dt_utc"].astimezone(TZ_LOCAL)
-        
-        # Пропускаем уже прошедшие даты
-        if run_local <= now_local:
-            continue
-            
-        note = item.get("note") or describe_part_of_day(run_local)
-        
-        # Проверяем, опубликован ли пост
-        if item.get("published", False):
-            line = f"• {run_local.strftime('%d.%m.%Y %H:%M')} ({note}) [опубликовано]"
-        else:
-            line = f"• {run_local.strftime('%d.%m.%Y %H:%M')} ({note})"
-            
-        lines.append(line)
-        shown_count += 1
-        if shown_count >= limit:
-            break
+SCHEDULE_PAGE_SIZE = 10
+# (первая будущая задача, страница) -> (строки, страница, всего страниц); сбрасывается plan_changed
+_schedule_page_cache = {}
+
+def _future_start() -> int:
+    """Индекс первой будущей задачи: список уже отсортирован, поэтому bisect, а не проход"""
+    return bisect.bisect_right(scheduled_tasks, time.time(), key=_task_sort_key)
+
+def format_task_line(item: PlannedTask) -> str:
+    run_local = item.run_dt_utc.astimezone(TZ_LOCAL)
+    note = describe_part_of_day(run_local)
+    # Проверяем, опубликован ли пост
+    if item.published:
+        return f"• {run_local.strftime('%d.%m.%Y %H:%M')} ({note}) [опубликовано]"
+    return f"• {run_local.strftime('%d.%m.%Y %H:%M')} ({note})"
 
-    return lines
+def get_scheduled_publications_info(limit: int = 50) -> list[str]:
+    start = _future_start()
+    return [format_task_line(item) for item in scheduled_tasks[start:start + limit]]
+
+def schedule_page(page: int) -> tuple:
+    """Страница будущих задач за O(размер страницы); готовые страницы живут до изменения плана"""
+    start = _future_start()
+    pages = max(1, -(-(len(scheduled_tasks) - start) // SCHEDULE_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    cached = _schedule_page_cache.get((start, page))
+    if cached is None:
+        first = start + page * SCHEDULE_PAGE_SIZE
+        lines = [format_task_line(item) for item in scheduled_tasks[first:first + SCHEDULE_PAGE_SIZE]]
+        cached = _schedule_page_cache[(start, page)] = (lines, page, pages)
+    return cached
 
 # ─────────────────────────────────────────────────────────────
 # Планировщик
 # ─────────────────────────────────────────────────────────────
 async def run_scheduler_loop():
     logging.info("=== ПЛАНИРОВЩИК ===")
+    await scheduler.run_forever()
+
+# ─────────────────────────────────────────────────────────────
+# Наблюдение за папками (inotify, иначе опрос)
+# ─────────────────────────────────────────────────────────────
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+_INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+class FolderWatcher:
+    """Следит за папками и после затишья в debounce секунд вызывает on_change один раз на всю пачку"""
+
+    def __init__(self, folders, on_change, debounce: float, poll_interval: float):
+        self.folders = list(folders)
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._loop = None
+        self._fd = None
+        self._poll_task = None
+        self._timer = None
+        self._first_event = None
+        self._task = None
+        self._dirty = False
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        if sys.platform.startswith("linux"):
+            try:
+                self._fd = self._inotify_open()
+                self._loop.add_reader(self._fd, self._on_readable)
+                logging.info(f"Наблюдение за папками: inotify, debounce {self.debounce:g} с")
+            except OSError as e:
+                logging.warning(f"inotify недоступен: {e}")
+                self._fd = None
+        if self._fd is None:
+            self._poll_task = self._loop.create_task(self._poll())
+            logging.info(f"Наблюдение за папками: опрос каждые {self.poll_interval:g} с")
+
+    def stop(self) -> None:
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _inotify_open(self) -> int:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        for folder in self.folders:
+            os.makedirs(folder, exist_ok=True)
+            if libc.inotify_add_watch(fd, os.fsencode(folder), WATCH_MASK) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, f"inotify_add_watch {folder}")
+        return fd
+
+    def _on_readable(self) -> None:
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        relevant = False
+        offset = 0
+        while offset + _INOTIFY_EVENT.size <= len(data):
+            _wd, mask, _cookie, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            # Скрытые файлы и подкаталоги (.opt, *.tmp-записи) очередь не меняют
+            if mask & IN_Q_OVERFLOW or not (mask & IN_ISDIR or name.startswith(b".")):
+                relevant = True
+        if relevant:
+            self._touch()
+
+    def _stat_folders(self) -> tuple:
+        result = []
+        for folder in self.folders:
+            try:
+                result.append(os.stat(folder).st_mtime_ns)
+            except FileNotFoundError:
+                result.append(None)
+        return tuple(result)
+
+    async def _poll(self) -> None:
+        seen = self._stat_folders()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            current = self._stat_folders()
+            if current != seen:
+                seen = current
+                self._touch()
+
+    def _touch(self) -> None:
+        """Каждое событие откладывает приём; при непрерывном потоке — не дольше 10 × debounce"""
+        now = self._loop.time()
+        if self._first_event is None:
+            self._first_event = now
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = min(self.debounce, max(0.0, self._first_event + self.debounce * 10 - now))
+        self._timer = self._loop.call_later(delay, self._fire)
+
+    def _fire(self) -> None:
+        self._timer = None
+        self._first_event = None
+        if self._task is not None and not self._task.done():
+            self._dirty = True  # повторим сразу после текущего прохода
+            return
+        self._task = self._loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            self._dirty = False
+            try:
+                await self.on_change()
+            except Exception as e:
+                logging.error(f"Ошибка приёма новых файлов: {e}", exc_info=True)
+            if not self._dirty:
+                break
+
+async def ingest_folder_changes() -> None:
+    """Приём изменений папок одним пакетом: скан, перенос в wait, одно обновление плана"""
+    # Свои переносы и удаления индекс уже учёл — тогда и делать нечего
+    if index_is_fresh(materials_folder) and index_is_fresh(pending_folder):
+        return
+    added, removed = await sync_material_queue(move_new=True)
+    if added or removed:
+        logging.info(f"Наблюдение: принято {len(added)} пар, снято {len(removed)}")
+
+folder_watcher = FolderWatcher(
+    (materials_folder, pending_folder), ingest_folder_changes, WATCH_DEBOUNCE, WATCH_POLL_INTERVAL
+)
+
+# ─────────────────────────────────────────────────────────────
+# Приём архивов с материалами (ZIP/TAR документом в бота)
+# ─────────────────────────────────────────────────────────────
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+def sniff_image_format(head: bytes):
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def _archive_members(archive):
+    """(имя, размер, открыть()) для обычных файлов архива; вложенные папки уплощаются"""
+    if isinstance(archive, zipfile.ZipFile):
+        for info in archive.infolist():
+            if not info.is_dir():
+                yield info.filename, info.file_size, lambda info=info: archive.open(info)
+    else:
+        for member in archive:
+            if member.isfile():  # ссылки и устройства не распаковываем
+                yield member.name, member.size, lambda member=member: archive.extractfile(member)
+
+def extract_archive(archive_path: str, staging: str, name_prefix: str) -> tuple:
+    """Распаковка с проверками; выполняется в пуле потоков.
+    Возвращает ([(картинка, подпись)] в staging, [(имя, причина)] отклонённых)"""
+    if zipfile.is_zipfile(archive_path):
+        archive = zipfile.ZipFile(archive_path)
+    elif tarfile.is_tarfile(archive_path):
+        archive = tarfile.open(archive_path, "r:*")
+    else:
+        return [], [(os.path.basename(archive_path), "не ZIP и не TAR")]
+
+    os.makedirs(staging, exist_ok=True)
+    images, texts, rejected = {}, {}, []
+    unpacked = 0
+    with archive:
+        for member_name, size, open_member in _archive_members(archive):
+            name = os.path.basename(member_name.replace("\\", "/"))
+            if not name or name.startswith(".") or "__MACOSX/" in member_name:
+                continue
+            stem, kind = classify_material(name)
+            if kind == "other":
+                rejected.append((name, "не картинка и не .txt"))
+                continue
+            target = images if kind == "image" else texts
+            if stem in target:
+                rejected.append((name, "повтор имени"))
+                continue
+            unpacked += size
+            if unpacked > UPLOAD_MAX_UNPACKED:
+                rejected.append((name, "архив слишком большой в распакованном виде"))
+                break
+            dst_name = name_prefix + name
+            with open_member() as src, open(os.path.join(staging, dst_name), "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            target[stem] = dst_name
+
+    pairs = []
+    for stem, image in images.items():
+        text_file = texts.pop(stem, None)
+        if text_file is None:
+            rejected.append((image[len(name_prefix):], "нет подписи"))
+            continue
+        reason = _validate_pair(os.path.join(staging, image), os.path.join(staging, text_file))
+        if reason:
+            rejected.append((image[len(name_prefix):], reason))
+            continue
+        pairs.append((image, text_file))
+    rejected.extend((text_file[len(name_prefix):], "нет картинки") for text_file in texts.values())
+    return pairs, rejected
+
+def _validate_pair(image_path: str, text_path: str):
+    """Причина отказа или None"""
+    with open(image_path, "rb") as f:
+        image_format = sniff_image_format(f.read(16))
+    if image_format is None:
+        return "неизвестный формат картинки"
+    if image_format == "gif" and not image_path.lower().endswith(".gif"):
+        return "GIF с расширением картинки"  # такие ушли бы фото, а не анимацией
+    try:
+        with open(text_path, "r", encoding="utf-8-sig") as f:
+            caption = f.read().strip()
+    except UnicodeDecodeError:
+        return "подпись не в UTF-8"
+    if len(caption) > CAPTION_MAX_LENGTH:
+        return f"подпись длиннее {CAPTION_MAX_LENGTH} ({len(caption)})"
+    return None
+
+async def ingest_archive(document: types.Document) -> tuple:
+    """Скачивание потоком на диск → распаковка в пуле → одно пакетное обновление очереди и плана"""
+    upload_dir = os.path.join(state_folder, "uploads", document.file_unique_id)
+    try:
+        os.makedirs(upload_dir, exist_ok=True)
+        archive_path = os.path.join(upload_dir, os.path.basename(document.file_name or "archive"))
+        await bot.download(document, destination=archive_path)
+        staging = os.path.join(upload_dir, "files")
+        # Префикс — file_unique_id: имена из разных архивов не пересекутся
+        prefix = document.file_unique_id + "-"
+        pairs, rejected = await run_io(extract_archive, archive_path, staging, prefix)
+        # Тот же архив повторно: пары из него уже лежат в materials/wait
+        taken = await storage.names(materials_folder) | await storage.names(pending_folder)
+        rejected.extend((image[len(prefix):], "уже загружено") for image, text_file in pairs if image in taken or text_file in taken)
+        pairs = [(image, text_file) for image, text_file in pairs if image not in taken and text_file not in taken]
+        if pairs:
+            await storage.add_files(staging, [name for pair in pairs for name in pair])
+        added, _ = await sync_material_queue(move_new=True)
+        if DEDUP_MODE == "skip":
+            # last_duplicates — вся сверка, включая давние дубликаты из wait; из этого архива — только с префиксом
+            for img, reason in last_duplicates:
+                name = os.path.basename(img)
+                if name.startswith(prefix):
+                    rejected.append((name[len(prefix):], reason))
+        return added, rejected
+    finally:
+        await run_io(shutil.rmtree, upload_dir, True)
+
+# ─────────────────────────────────────────────────────────────
+# Выбор ведущего (аренда в общей SQLite)
+# ─────────────────────────────────────────────────────────────
+LEASE_NAME = "scheduler"
+# Запас на расхождение часов и задержку продления: публикуем, только пока аренда точно наша
+LEASE_SAFETY_MARGIN = min(2.0, LEASE_TTL / 4)
+READ_ONLY_TEXTS = frozenset({"📊 Статистика", "📅 Расписание"})
+
+_is_leader = False
+_lease_valid_until = 0.0
+_leader_url = None
+_scheduler_task = None
+_leading_task = None  # подъём плана новым ведущим; аренда тем временем продлевается отдельно
+_mirror_stamp = None
+_forward_session = None
+
+def lease_acquire(name: str, holder: str, holder_url: str, ttl: float) -> tuple:
+    """Берёт или продлевает аренду атомарно; возвращает (наша ли она, адрес держателя)"""
+    now = time.time()
+    with _db_lock:
+        db = get_db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                "INSERT INTO leases (name, holder, holder_url, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, holder_url = excluded.holder_url, "
+                "expires_at = excluded.expires_at WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                (name, holder, holder_url, now + ttl, now),
+            )
+            row = db.execute("SELECT holder, holder_url FROM leases WHERE name = ?", (name,)).fetchone()
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    return row[0] == holder, row[1]
+
+def lease_release(name: str, holder: str) -> None:
+    with _db_lock:
+        get_db().execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+def lease_is_valid() -> bool:
+    """Можно ли этой реплике публиковать и писать журнал"""
+    if not LEADER_ELECTION:
+        return True
+    return _is_leader and time.time() < _lease_valid_until - LEASE_SAFETY_MARGIN
+
+async def start_planning() -> None:
+    """План из общего журнала (или с нуля), повторы из outbox и наблюдение за папками"""
+    global _mirror_stamp
+    _mirror_stamp = None
+    scheduler.clear('post')
+    if not await restore_plan():
+        await load_and_move_materials()
+        if material_pairs:
+            schedule_posts()
+    restore_retries()
+    if WATCH_FOLDERS and storage.local:
+        folder_watcher.start()
+
+async def lead() -> None:
+    global _scheduler_task
+    try:
+        # Кэши дедупа — копии общей базы: прежний ведущий мог их дополнить
+        await run_io(reset_dedup_caches)
+        # Продолжаем с того места, где остановился прежний ведущий: его журнал общий
+        await start_planning()
+        _scheduler_task = asyncio.create_task(run_scheduler_loop())
+    except Exception as e:
+        logging.error(f"Ошибка подъёма плана: {e}", exc_info=True)
+
+def become_leader() -> None:
+    """Холодный скан с хэшированием может идти дольше LEASE_TTL — план поднимается в своей задаче,
+    а leadership_loop продолжает продлевать аренду"""
+    global _is_leader, _leading_task
+    logging.info(f"Реплика {REPLICA_ID} стала ведущей")
+    _is_leader = True
+    _leading_task = asyncio.create_task(lead())
+
+def step_down() -> None:
+    """Аренда потеряна: останавливаем всё, что публикует или пишет журнал"""
+    global _is_leader, _scheduler_task, _leading_task, _catchup_queue
+    logging.warning(f"Реплика {REPLICA_ID} больше не ведущая")
+    _is_leader = False
+    if _leading_task is not None:
+        _leading_task.cancel()
+        _leading_task = None
+    if _scheduler_task is not None:
+        _scheduler_task.cancel()
+        _scheduler_task = None
+    for tag in ('post', 'retry', 'album', 'test'):
+        scheduler.clear(tag)
+    for worker in _catchup_workers:
+        worker.cancel()
+    _catchup_workers.clear()
+    _catchup_queue = None
+    folder_watcher.stop()
+    prefetcher.stop()
+    _journal_executor.submit(_journal_close)
+
+async def leadership_loop() -> None:
+    """Продление аренды; без продления за LEASE_TTL её забирает другая реплика"""
+    global _lease_valid_until, _leader_url
     while True:
-        schedule.run_pending()
-        await asyncio.sleep(10)
+        started = time.time()
+        try:
+            acquired, _leader_url = await run_io(lease_acquire, LEASE_NAME, REPLICA_ID, REPLICA_URL, LEASE_TTL)
+        except Exception as e:
+            logging.error(f"Аренда не продлена: {e}")
+            acquired = False
+        if acquired:
+            _lease_valid_until = started + LEASE_TTL
+            if not _is_leader:
+                become_leader()
+        elif _is_leader:
+            step_down()
+        await asyncio.sleep(LEASE_RENEW_INTERVAL)
+
+async def refresh_mirror() -> None:
+    """Ведомая реплика перечитывает общий журнал, если ведущий его изменил"""
+    global _mirror_stamp
+    try:
+        st = os.stat(JOURNAL_PATH)
+    except FileNotFoundError:
+        return
+    stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+    if stamp != _mirror_stamp:
+        _mirror_stamp = stamp
+        await restore_plan(mirror=True)
+
+def is_read_only_update(update: types.Update) -> bool:
+    if update.message is not None:
+        return update.message.text in READ_ONLY_TEXTS
+    if update.callback_query is not None:
+        return (update.callback_query.data or "").startswith("sched_page_")
+    return False
+
+async def forward_to_leader(update: types.Update) -> bool:
+    global _forward_session
+    if not _leader_url:
+        return False
+    if _forward_session is None:
+        _forward_session = ClientSession(timeout=ClientTimeout(total=10))
+    try:
+        payload = update.model_dump(mode="json", exclude_none=True)
+        async with _forward_session.post(f"{_leader_url}/webhook", json=payload) as resp:
+            return resp.status < 300
+    except Exception as e:
+        logging.error(f"Не удалось переслать апдейт ведущему {_leader_url}: {e}")
+        return False
+
+@dp.update.outer_middleware()
+async def replica_routing(handler, update: types.Update, data: dict):
+    """Ведомая реплика сама отвечает только на просмотр; остальное — ведущему"""
+    if not LEADER_ELECTION or _is_leader:
+        return await handler(update, data)
+    if is_read_only_update(update):
+        await refresh_mirror()
+        return await handler(update, data)
+    if await forward_to_leader(update):
+        return None
+    logging.warning(f"Апдейт {update.update_id} отброшен: ведущая реплика недоступна")
+    chat_id = update.message.chat.id if update.message is not None else None
+    if chat_id is None and update.callback_query is not None and update.callback_query.message is not None:
+        chat_id = update.callback_query.message.chat.id
+    if chat_id is not None:
+        await bot.send_message(chat_id, "⚠️ Ведущий экземпляр сейчас недоступен, повторите через минуту")
+    return None
+
+# ─────────────────────────────────────────────────────────────
+# Поэтапный старт
+# ─────────────────────────────────────────────────────────────
+WEBHOOK_URL = f"{APP_BASE_URL}/webhook"
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+# Сервер принимает апдейты сразу, а хендлеры ждут, пока поднимется план
+startup_done = asyncio.Event()
+_startup_task = None
+
+@dp.update.outer_middleware()
+async def wait_for_startup(handler, update: types.Update, data: dict):
+    if not startup_done.is_set():
+        await startup_done.wait()
+    return await handler(update, data)
 
 # ─────────────────────────────────────────────────────────────
 # Хендлеры команд/кнопок
 # ─────────────────────────────────────────────────────────────
+# Кнопки reply-клавиатуры: текст -> хендлер; один поиск в словаре вместо перебора фильтров
+TEXT_BUTTONS = {}
+
+def text_button(text: str):
+    def register(handler):
+        TEXT_BUTTONS[text] = handler
+        return handler
+    return register
+
+@dp.message(F.text.in_(TEXT_BUTTONS))
+async def route_text_button(message: types.Message):
+    await TEXT_BUTTONS[message.text](message)
+
 @dp.message(Command(commands=["start"]))
 async def cmd_start(message: types.Message):
     welcome_text = (
@@ -369,163 +3293,197 @@ async def cmd_start(message: types.Message):
     )
     await message.answer(welcome_text, parse_mode="HTML", reply_markup=get_main_keyboard())
 
-    load_and_move_materials()
-    if material_pairs:
-        schedule_posts()
+    set_plan_paused(False)
+    await sync_material_queue()
+
+@dp.message(F.document)
+async def handle_archive(message: types.Message):
+    if message.from_user is None or message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ Загружать материалы могут только администраторы (ADMIN_IDS)")
+        return
+    document = message.document
+    if not (document.file_name or "").lower().endswith(ARCHIVE_EXTENSIONS):
+        await message.answer("📦 Пришлите ZIP или TAR с парами картинка + .txt с тем же именем")
+        return
+    if document.file_size and document.file_size > UPLOAD_MAX_BYTES:
+        await message.answer(f"❌ Архив больше {UPLOAD_MAX_BYTES // (1024 * 1024)} МБ")
+        return
 
-@dp.message(lambda message: message.text == "📊 Статистика")
+    await message.answer("📦 Архив получен, распаковываю...")
+    try:
+        added, rejected = await ingest_archive(document)
+    except Exception as e:
+        logging.error(f"Ошибка приёма архива {document.file_name}: {e}", exc_info=True)
+        await message.answer(f"❌ Ошибка: {e}", reply_markup=get_main_keyboard())
+        return
+
+    logging.info(f"Архив {document.file_name}: принято {len(added)}, отклонено {len(rejected)}")
+    response = f"📦 <b>{html.escape(document.file_name)}</b>\n\n✅ в очереди новых публикаций: {len(added)}\n"
+    if rejected:
+        response += f"⚠️ отклонено: {len(rejected)}\n"
+        for name, reason in rejected[:10]:
+            response += f"   • {html.escape(name)}: {html.escape(reason)}\n"
+        if len(rejected) > 10:
+            response += f"   ... и ещё {len(rejected) - 10}\n"
+    response += f"📋 очередь: {len(material_pairs)} публикаций"
+    await message.answer(response, parse_mode="HTML", reply_markup=get_main_keyboard())
+
+@text_button("📊 Статистика")
 async def button_stats(message: types.Message):
     try:
-        refresh_material_queue()
-        materials_files = len([f for f in os.listdir(materials_folder) if os.path.isfile(os.path.join(materials_folder, f))]) if os.path.exists(materials_folder) else 0
-        materials_pairs = materials_files // 2
-        wait_files = len([f for f in os.listdir(pending_folder) if os.path.isfile(os.path.join(pending_folder, f))]) if os.path.exists(pending_folder) else 0
-        wait_pairs = wait_files // 2
+        await refresh_material_queue()
+        materials_files, materials_pairs, materials_orphans = await storage.stats(materials_folder)
+        wait_files, wait_pairs, wait_orphans = await storage.stats(pending_folder)
 
         response = "📊 <b>Статистика:</b>\n\n"
         response += f"📥 materials: {materials_pairs} ({materials_files} файлов)\n"
+        if materials_orphans:
+            response += f"   ⚠️ без пары: {materials_orphans}\n"
         response += f"⏳ wait: {wait_pairs} ({wait_files} файлов)\n"
+        if wait_orphans:
+            response += f"   ⚠️ без пары: {wait_orphans}\n"
         response += f"📋 очередь: {len(material_pairs)} публикаций\n"
-        response += f"📅 запланировано: {len([j for j in schedule.jobs if 'post' in getattr(j, 'tags', [])])} задач\n"
+        if last_duplicates:
+            response += f"   🔁 дубликатов при последней сверке: {len(last_duplicates)}\n"
+        response += f"📅 запланировано: {scheduler.count('post')} задач\n"
+        retrying, dead = await run_io(outbox_counts)
+        if retrying or dead:
+            response += f"🔁 повторы: {retrying}, не доставлено: {dead}\n"
         response += f"⚙️ частота: {PUBLICATIONS_PER_DAY} постов/день\n"
 
         await message.answer(response, parse_mode="HTML", reply_markup=get_main_keyboard())
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}", reply_markup=get_main_keyboard())
 
-@dp.message(lambda message: message.text == "📅 Расписание")
+@text_button("📅 Расписание")
 async def button_schedule(message: types.Message):
-    refresh_material_queue()
+    await refresh_material_queue()
 
     if not material_pairs:
         await message.answer("📭 Очередь пуста.", reply_markup=get_main_keyboard())
         return
 
+    response, keyboard = render_schedule(0)
+    await message.answer(response, parse_mode="HTML", reply_markup=keyboard or get_main_keyboard())
+
+def render_schedule(page: int) -> tuple:
+    """Текст расписания и инлайн-клавиатура страниц (None, если страница одна)"""
     response = "📅 <b>Планирование:</b>\n\n"
     response += "⏳ <b>В очереди:</b>\n"
-    for i, (image_path, text_path) in enumerate(material_pairs[:15], 1):
+    for i, (image_path, text_path) in enumerate(material_pairs.head(15), 1):
         filename = os.path.basename(image_path)
         for ext in ('.jpg', '.jpeg', '.png', '.gif', '.webp'):
             if filename.lower().endswith(ext):
                 filename = filename[:-len(ext)]
                 break
-        response += f"{i}. {filename}\n"
+        response += f"{i}. {html.escape(filename)}\n"
 
     response += f"\n📊 Всего: {len(material_pairs)} публикаций\n"
 
-    lines = get_scheduled_publications_info(limit=50)
+    lines, page, pages = schedule_page(page)
     if lines:
         response += "\n⏰ <b>Запланировано:</b>\n" + "\n".join(lines) + "\n"
     else:
         response += "\n⏰ Нет запланированных публикаций\n"
 
-    await message.answer(response, parse_mode="HTML", reply_markup=get_main_keyboard())
-
-@dp.message(lambda message: message.text == "🔄 Перезагрузить")
-async def button_reload(message: types.Message):
+    if pages <= 1:
+        return response, None
+    buttons = []
+    if page > 0:
+        buttons.append(types.InlineKeyboardButton(text="◀️", callback_data=f"sched_page_{page - 1}"))
+    buttons.append(types.InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=f"sched_page_{page}"))
+    if page < pages - 1:
+        buttons.append(types.InlineKeyboardButton(text="▶️", callback_data=f"sched_page_{page + 1}"))
+    return response, types.InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+@dp.callback_query(F.data.startswith("sched_page_"))
+async def handle_schedule_page(query: CallbackQuery):
+    await query.answer()
+    response, keyboard = render_schedule(int(query.data.rsplit("_", 1)[1]))
     try:
-        schedule.clear('post')
-        schedule.clear('test')  # Также очищаем тестовые задачи
-    except Exception as e:
-        logging.warning(f"Ошибка очистки: {e}")
-    global material_pairs
-    material_pairs = []
+        await query.message.edit_text(response, parse_mode="HTML", reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            logging.error(f"Ошибка страницы расписания: {e}")
 
-    load_and_move_materials()
+@text_button("🔄 Перезагрузить")
+async def button_reload(message: types.Message):
+    scheduler.clear('test')  # Тестовые задачи очищаем, план обновляем по разнице
+    set_plan_paused(False)
+    added, removed = await sync_material_queue()
     if material_pairs:
-        schedule_posts()
+        duplicates = f" Дубликатов: {len(last_duplicates)}." if last_duplicates else ""
         await message.answer(
-            f"✅ Загружено {len(material_pairs)} публикаций. "
-            f"Запланировано {len([j for j in schedule.jobs if 'post' in getattr(j, 'tags', [])])} постов.",
+            f"✅ Загружено {len(material_pairs)} публикаций (+{len(added)}, -{len(removed)}). "
+            f"Запланировано {scheduler.count('post')} постов.{duplicates}",
             reply_markup=get_main_keyboard()
         )
     else:
         await message.answer("❌ Нет публикаций.", reply_markup=get_main_keyboard())
 
-@dp.message(lambda message: message.text == "⏹ Остановить")
+@text_button("⏹ Остановить")
 async def button_stop(message: types.Message):
-    try:
-        schedule.clear('post')
-        schedule.clear('test')  # Также очищаем тестовые задачи
-    except Exception as e:
-        logging.warning(f"Ошибка очистки: {e}")
-    global material_pairs
+    scheduler.clear('post')
+    scheduler.clear('test')  # Также очищаем тестовые задачи
     cleared_count = len(material_pairs)
-    material_pairs = []
+    material_pairs.clear()
+    reset_plan()
+    journal_compact()
+    await outbox_clear()
     await message.answer(
         f"⏹ Остановлено!\nОчередь очищена: {cleared_count} публикаций",
         reply_markup=get_main_keyboard()
     )
 
-@dp.message(lambda message: message.text == "⏸ Пауза")
+@text_button("⏸ Пауза")
 async def button_pause(message: types.Message):
-    try:
-        schedule.clear('post')
-        schedule.clear('test')  # Также очищаем тестовые задачи
-    except Exception as e:
-        logging.warning(f"Ошибка очистки: {e}")
+    scheduler.clear('post')
+    scheduler.clear('test')  # Также очищаем тестовые задачи
+    # Очередь сохраняется, план сбрасывается — после рестарта пауза не снимется сама
+    reset_plan()
+    set_plan_paused(True)
+    journal_compact()
     await message.answer("⏸ Пауза", reply_markup=get_main_keyboard())
 
-@dp.message(lambda message: message.text == "▶️ Продолжить")
+@text_button("▶️ Продолжить")
 async def button_resume(message: types.Message):
+    set_plan_paused(False)
     if material_pairs:
-        schedule_posts()
+        # После паузы план пуст и строится заново с сегодняшнего дня; иначе лишь досоздаётся
+        top_up_plan()
         await message.answer(
             f"▶️ Возобновлено. "
-            f"Запланировано {len([j for j in schedule.jobs if 'post' in getattr(j, 'tags', [])])} постов.",
+            f"Запланировано {scheduler.count('post')} постов.",
             reply_markup=get_main_keyboard()
         )
     else:
-        load_and_move_materials()
+        await load_and_move_materials()
         if material_pairs:
             schedule_posts()
             await message.answer(
                 f"▶️ Возобновлено. "
-                f"Запланировано {len([j for j in schedule.jobs if 'post' in getattr(j, 'tags', [])])} постов.",
+                f"Запланировано {scheduler.count('post')} постов.",
                 reply_markup=get_main_keyboard()
             )
         else:
             await message.answer("📭 Нет публикаций.", reply_markup=get_main_keyboard())
 
-@dp.message(lambda message: message.text == "🧹 Полная очистка")
+@text_button("🧹 Полная очистка")
 async def button_full_clear(message: types.Message):
-    try:
-        schedule.clear('post')
-        schedule.clear('test')  # Также очищаем тестовые задачи
-    except Exception as e:
-        logging.warning(f"Ошибка очистки: {e}")
+    scheduler.clear('post')
+    scheduler.clear('test')  # Также очищаем тестовые задачи
 
-    global material_pairs
     cleared_memory = len(material_pairs)
-    material_pairs = []
-
-    deleted_materials = 0
-    if os.path.exists(materials_folder):
-        try:
-            for filename in os.listdir(materials_folder):
-                file_path = os.path.join(materials_folder, filename)
-                try:
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
-                        deleted_materials += 1
-                except Exception as e:
-                    logging.error(f"Ошибка {filename}: {e}")
-        except Exception as e:
-            logging.error(f"Ошибка materials: {e}")
-
-    deleted_wait = 0
-    if os.path.exists(pending_folder):
-        try:
-            for filename in os.listdir(pending_folder):
-                file_path = os.path.join(pending_folder, filename)
-                try:
-                    if os.path.isfile(file_path):
-                        os.remove(file_path)
-                        deleted_wait += 1
-                except Exception as e:
-                    logging.error(f"Ошибка wait {filename}: {e}")
-        except Exception as e:
-            logging.error(f"Ошибка wait: {e}")
+    material_pairs.clear()
+    reset_plan()
+    journal_compact()
+    await outbox_clear()
+
+    # Каждая папка очищается одним заходом в пул потоков
+    deleted_materials, deleted_wait = await asyncio.gather(
+        storage.clear(materials_folder),
+        storage.clear(pending_folder),
+    )
 
     response = (
         f"🧹 Очистка завершена!\n\n"
@@ -535,7 +3493,7 @@ async def button_full_clear(message: types.Message):
     )
     await message.answer(response, parse_mode="HTML", reply_markup=get_main_keyboard())
 
-@dp.message(lambda message: message.text == "⚙️ Настройки")
+@text_button("⚙️ Настройки")
 async def button_settings(message: types.Message):
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
         [types.InlineKeyboardButton(text="1 пост/день", callback_data="freq_1")],
@@ -552,19 +3510,18 @@ async def button_settings(message: types.Message):
         reply_markup=keyboard
     )
 
-@dp.message(lambda message: message.text == "🧪 Тест (5 сек)")
+@text_button("🧪 Тест (5 сек)")
 async def button_test_fast(message: types.Message):
     if not material_pairs:
-        load_and_move_materials()
+        await load_and_move_materials()
 
     if len(material_pairs) >= 1:
-        first_pair = material_pairs[0]
+        first_pair = material_pairs.first()
         
         def test_publish():
             asyncio.create_task(send_material_pair(first_pair[0], first_pair[1]))
-            return schedule.CancelJob
-        
-        schedule.every(5).seconds.do(test_publish).tag('test')
+
+        scheduler.add(datetime.now(timezone.utc) + timedelta(seconds=5), test_publish, 'test')
         
         await message.answer("🚀 Тест через 5 секунд", reply_markup=get_main_keyboard())
     else:
@@ -582,18 +3539,16 @@ async def handle_frequency_change(query: CallbackQuery):
             old_freq = PUBLICATIONS_PER_DAY
             PUBLICATIONS_PER_DAY = new_freq
 
-            try:
-                schedule.clear('post')
-                schedule.clear('test')  # Также очищаем тестовые задачи
-            except Exception as e:
-                logging.warning(f"Ошибка очистки: {e}")
+            scheduler.clear('test')  # Также очищаем тестовые задачи
+            set_plan_paused(False)
 
-            material_pairs.clear()
-            load_and_move_materials()
+            if material_pairs:
+                retime_plan()
+            else:
+                await sync_material_queue()
 
             if material_pairs:
-                schedule_posts()
-                scheduled_count = len([j for j in schedule.jobs if 'post' in getattr(j, 'tags', [])])
+                scheduled_count = scheduler.count('post')
                 message_text = (
                     f"✅ Частота изменена!\n"
                     f"{old_freq} → {PUBLICATIONS_PER_DAY} постов/день\n"
@@ -624,42 +3579,183 @@ async def handle_frequency_change(query: CallbackQuery):
 # ─────────────────────────────────────────────────────────────
 # Webhook handlers
 # ─────────────────────────────────────────────────────────────
-async def on_startup(bot: Bot):
-    logging.info("=== СТАРТ НА RENDER ===")
-    
+async def ensure_webhook(bot: Bot) -> None:
+    """set_webhook только если адрес или типы апдейтов изменились; накопившиеся апдейты не сбрасываем"""
+    info = await bot.get_webhook_info()
+    if info.url == WEBHOOK_URL and sorted(info.allowed_updates or ALLOWED_UPDATES) == sorted(ALLOWED_UPDATES):
+        logging.info(f"Webhook уже настроен: {WEBHOOK_URL}, ожидает апдейтов: {info.pending_update_count}")
+        return
+    await bot.set_webhook(WEBHOOK_URL, allowed_updates=ALLOWED_UPDATES, drop_pending_updates=False)
+    logging.info(f"Webhook: {WEBHOOK_URL}")
+
+async def staged_startup(bot: Bot) -> None:
+    """Всё медленное после того, как сервер уже отвечает: вебхук, журнал, скан папок, план"""
+    started = time.perf_counter()
     try:
-        schedule.clear('post')
-        schedule.clear('test')  # Также очищаем тестовые задачи
+        await ensure_webhook(bot)
     except Exception as e:
-        logging.error(f"Ошибка: {e}", exc_info=True)
-
-    WEBHOOK_URL = f"{APP_BASE_URL}/webhook"
-    await bot.set_webhook(
-        WEBHOOK_URL,
-        allowed_updates=["message", "callback_query"],
-        drop_pending_updates=True,
-    )
-    logging.info(f"Webhook: {WEBHOOK_URL}")
+        logging.error(f"Webhook не настроен: {e}", exc_info=True)
+    try:
+        if LEADER_ELECTION:
+            # План поднимет та реплика, что возьмёт аренду; остальные только принимают вебхуки
+            asyncio.create_task(leadership_loop())
+        else:
+            asyncio.create_task(run_scheduler_loop())
+            # Тёплый старт из журнала; если плана нет — загружаем материалы из текущей среды
+            await start_planning()
+    except Exception as e:
+        logging.error(f"Ошибка запуска: {e}", exc_info=True)
+    finally:
+        startup_done.set()
+    logging.info(f"Готов к работе за {time.perf_counter() - started:.2f} с")
 
-    asyncio.create_task(run_scheduler_loop())
+async def on_startup(bot: Bot):
+    global _startup_task
+    logging.info("=== СТАРТ НА RENDER ===")
     
-    # При запуске на Render загружаем материалы из текущей среды
-    load_and_move_materials()
-    if material_pairs:
-        schedule_posts()
+    scheduler.clear('post')
+    scheduler.clear('test')  # Также очищаем тестовые задачи
+
+    # Не ждём: /health и /webhook должны отвечать сразу после старта сервера
+    _startup_task = asyncio.create_task(staged_startup(bot))
 
 async def on_shutdown(bot: Bot):
     logging.info("=== СТОП ===")
+    folder_watcher.stop()
+    prefetcher.stop()
+    if LEADER_ELECTION:
+        if _is_leader:
+            # Отдаём аренду сразу, чтобы другая реплика не ждала LEASE_TTL
+            step_down()
+            await run_io(lease_release, LEASE_NAME, REPLICA_ID)
+        if _forward_session is not None:
+            await _forward_session.close()
+    # Дописываем журнал до конца: записи стоят в очереди его потока
+    await run_journal(_journal_close)
+    await storage.close()
+    if _optimize_executor is not None:
+        _optimize_executor.shutdown(wait=False, cancel_futures=True)
     await bot.session.close()
 
 async def health(request: web.Request):
     return web.Response(text="OK")
 
+async def ready(request: web.Request):
+    if not startup_done.is_set():
+        return web.Response(status=503, text="starting")
+    return web.Response(text="READY")
+
 async def tick(request: web.Request):
     if request.query.get("token") != TICK_TOKEN:
         return web.Response(status=403, text="forbidden")
-    schedule.run_pending()
-    return web.Response(text="tick")
+    # Сам проход планировщика идёт в фоне — ответ сразу, с ближайшим дедлайном для внешнего cron
+    scheduler.wakeup()
+    next_run = scheduler.next_run()
+    return web.json_response({
+        "next_due_utc": next_run.isoformat() if next_run else None,
+        "pending": len(scheduler),
+        "catchup": catchup_backlog(),
+    })
+
+async def metrics(request: web.Request):
+    if request.query.get("token", "") != METRICS_TOKEN:
+        return web.Response(status=403, text="forbidden")
+    retrying, dead = await run_io(outbox_counts)
+    lines = []
+    for metric in (
+        SEND_SECONDS, WEBHOOK_SECONDS, WEBHOOK_INGRESS_SECONDS, SCHEDULER_LAG, SENDS_TOTAL, SEND_FAILURES_TOTAL,
+        RETRIES_TOTAL, WEBHOOK_UPDATES_TOTAL, PREFETCH_TOTAL,
+    ):
+        lines.extend(metric.render())
+    lines += render_gauge("alnpost_queue_depth", "Пар в очереди на публикацию", len(material_pairs))
+    lines += render_gauge("alnpost_wait_files", "Файлов в wait/", (await storage.stats(pending_folder))[0])
+    lines += render_gauge("alnpost_jobs_pending", "Задач в планировщике", len(scheduler))
+    lines += render_gauge("alnpost_prefetch_bytes", "Байт в буфере предзагрузки", prefetcher.size)
+    lines += render_gauge("alnpost_outbox_retrying", "Отправок в ожидании повтора", retrying)
+    lines += render_gauge("alnpost_dead_letters", "Недоставленных отправок", dead)
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain", charset="utf-8")
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Фоновая обработка вебхука: очередь на воркера, апдейты одного чата — всегда в одном воркере
+    (порядок команд сохраняется), повторы update_id от Telegram отбрасываются"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int, queue_size: int, dedup_size: int, **data):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **data)
+        self._queues = [asyncio.Queue(maxsize=queue_size) for _ in range(max(1, workers))]
+        self._workers = []
+        self._seen = OrderedDict()  # LRU update_id
+        self.dedup_size = dedup_size
+
+    @staticmethod
+    def _chat_key(update: dict):
+        for kind in ("message", "edited_message", "channel_post"):
+            if kind in update:
+                return update[kind].get("chat", {}).get("id")
+        query = update.get("callback_query")
+        if query is not None:
+            return query.get("from", {}).get("id")
+        return update.get("update_id")
+
+    def _remember(self, update_id) -> bool:
+        """False — этот update_id уже принимали"""
+        if update_id in self._seen:
+            self._seen.move_to_end(update_id)
+            return False
+        self._seen[update_id] = None
+        if len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+        return True
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        update_id = update.get("update_id")
+        if update_id is not None and not self._remember(update_id):
+            WEBHOOK_UPDATES_TOTAL.inc("duplicate")
+            return web.json_response({}, dumps=bot.session.json_dumps)
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(bot, queue)) for queue in self._queues]
+        queue = self._queues[hash(self._chat_key(update)) % len(self._queues)]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self._seen.pop(update_id, None)  # повтор от Telegram должен пройти
+            WEBHOOK_UPDATES_TOTAL.inc("rejected")
+            return web.Response(status=503, text="busy")
+        WEBHOOK_UPDATES_TOTAL.inc("queued")
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _worker(self, bot: Bot, queue: asyncio.Queue) -> None:
+        while True:
+            update = await queue.get()
+            started = time.perf_counter()
+            try:
+                await self._background_feed_update(bot, update)
+            except Exception as e:
+                logging.error(f"Ошибка обработки апдейта {update.get('update_id')}: {e}", exc_info=True)
+            finally:
+                # Ответ Telegram ушёл ещё при постановке в очередь — задержку хендлеров меряем здесь
+                WEBHOOK_SECONDS.observe(time.perf_counter() - started)
+                queue.task_done()
+
+    async def drain(self) -> None:
+        """Ждёт, пока будут обработаны все принятые апдейты"""
+        await asyncio.gather(*(queue.join() for queue in self._queues))
+
+    async def close(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+        await super().close()
+
+@web.middleware
+async def webhook_timing(request: web.Request, handler):
+    if request.path != "/webhook":
+        return await handler(request)
+    started = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        WEBHOOK_INGRESS_SECONDS.observe(time.perf_counter() - started)
 
 def main():
     logging.info("=== СТАРТ НА RENDER ===")
@@ -669,13 +3765,17 @@ def main():
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
 
-    app = web.Application()
-    webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+    app = web.Application(middlewares=[webhook_timing])
+    webhook_requests_handler = QueuedRequestHandler(
+        dp, bot, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_DEDUP_SIZE,
+    )
     webhook_requests_handler.register(app, path="/webhook")
 
     app.router.add_get("/", lambda r: web.Response(text="Bot is running"))
     app.router.add_get("/health", health)
+    app.router.add_get("/ready", ready)
     app.router.add_get("/tick", tick)
+    app.router.add_get("/metrics", metrics)
 
     setup_application(app, dp, bot=bot)
     web.run_app(app, host="0.0.0.0", port=port)
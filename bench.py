@@ -0,0 +1,404 @@
+"""Нагрузочные замеры alnbot на синтетическом корпусе с заглушкой Bot API.
+
+Запуск:  python bench.py --sizes 1000,10000,100000 --output bench_output.txt
+Каждый размер корпуса замеряется в отдельном процессе (у alnbot глобальное состояние),
+результат — JSON со временем каждого сценария.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from xml.sax.saxutils import escape
+
+from aiohttp import ClientSession, web
+
+BENCH_TOKEN = "123456:bench"
+CHAT_IDS = ["-1001", "-1002"]
+WORDS = "утро вечер море город свет тень дорога ветер осень зима лето весна окно сад".split()
+
+# ─────────────────────────────────────────────────────────────
+# Синтетический корпус
+# ─────────────────────────────────────────────────────────────
+def generate_corpus(folder: str, count: int, image_bytes: int, seed: int = 0) -> None:
+    """count пар N.jpg + N.txt; картинки — случайные байты (заглушка API их не разбирает),
+    у каждой свои: одинаковые отсеял бы дедуп контента"""
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        stem = f"{i:06d}"
+        with open(os.path.join(folder, stem + ".jpg"), "wb") as f:
+            f.write(rng.randbytes(image_bytes))
+        with open(os.path.join(folder, stem + ".txt"), "w", encoding="utf-8") as f:
+            f.write(" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 30))))
+
+# ─────────────────────────────────────────────────────────────
+# Заглушка Bot API
+# ─────────────────────────────────────────────────────────────
+class FakeBotAPI:
+    """Отвечает как Telegram: задержка latency сек, с вероятностью rate_429 — 429 с retry_after"""
+
+    def __init__(self, latency: float, rate_429: float, retry_after: int = 1, seed: int = 0):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.calls = {}
+        self.throttled = 0
+        self.uploaded_bytes = 0
+        self._message_id = 0
+        self._runner = None
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        # Тело читаем целиком, как настоящий сервер: загрузка входит в замер
+        body = await request.read()
+        self.uploaded_bytes += len(body)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rate_429 and self.rng.random() < self.rate_429:
+            self.throttled += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        return web.json_response({"ok": True, "result": self._result(method)})
+
+    def _message(self, **extra) -> dict:
+        self._message_id += 1
+        return {"message_id": self._message_id, "date": int(time.time()), "chat": {"id": -1001, "type": "channel"}, **extra}
+
+    def _result(self, method: str):
+        photo = [{"file_id": f"photo{self._message_id}", "file_unique_id": f"u{self._message_id}", "width": 1, "height": 1}]
+        if method == "sendPhoto":
+            return self._message(photo=photo)
+        if method == "sendMediaGroup":
+            return [self._message(photo=photo) for _ in range(2)]
+        if method == "sendMessage":
+            return self._message(text="ok")
+        return True
+
+    async def start(self) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+# ─────────────────────────────────────────────────────────────
+# Заглушка S3 (в духе MinIO)
+# ─────────────────────────────────────────────────────────────
+class FakeS3:
+    """Один бакет в памяти, path-style: ListObjectsV2 с постраничной выдачей, GET/HEAD/PUT (в т.ч. copy)/DELETE.
+    Подпись не проверяется — только то, что запрос подписан"""
+
+    def __init__(self, bucket: str, page_size: int = 1000):
+        self.bucket = bucket
+        self.page_size = page_size
+        self.objects = {}  # key -> bytes
+        self.calls = {}
+        self.streamed_bytes = 0
+        self._runner = None
+
+    def put(self, key: str, data: bytes) -> None:
+        self.objects[key] = data
+
+    @staticmethod
+    def _etag(data: bytes) -> str:
+        return '"' + hashlib.md5(data).hexdigest() + '"'
+
+    async def handle(self, request: web.Request):
+        if not request.headers.get("Authorization", "").startswith("AWS4-HMAC-SHA256 "):
+            return web.Response(status=403, text="AccessDenied")
+        if request.match_info["bucket"] != self.bucket:
+            return web.Response(status=404, text="NoSuchBucket")
+        key = request.match_info.get("key", "")
+        op = f"{request.method} {'object' if key else 'bucket'}"
+        self.calls[op] = self.calls.get(op, 0) + 1
+        if not key:
+            return self._list(request)
+        if request.method == "PUT":
+            source = request.headers.get("x-amz-copy-source")
+            if source is not None:
+                data = self.objects.get(source.split("/", 2)[2])
+                if data is None:
+                    return web.Response(status=404, text="NoSuchKey")
+            else:
+                data = await request.read()
+            self.objects[key] = data
+            return web.Response(headers={"ETag": self._etag(data)})
+        if request.method == "DELETE":
+            self.objects.pop(key, None)
+            return web.Response(status=204)
+        data = self.objects.get(key)
+        if data is None:
+            return web.Response(status=404, text="NoSuchKey")
+        if request.method == "HEAD":
+            return web.Response(headers={"ETag": self._etag(data), "Content-Length": str(len(data))})
+        self.streamed_bytes += len(data)
+        return web.Response(body=data, headers={"ETag": self._etag(data)})
+
+    def _list(self, request: web.Request) -> web.Response:
+        prefix = request.query.get("prefix", "")
+        keys = sorted(key for key in self.objects if key.startswith(prefix))
+        start = int(request.query.get("continuation-token", "0"))
+        page = keys[start:start + self.page_size]
+        truncated = start + self.page_size < len(keys)
+        body = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+            f"<Name>{self.bucket}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>",
+            f"<IsTruncated>{'true' if truncated else 'false'}</IsTruncated>",
+        ]
+        if truncated:
+            body.append(f"<NextContinuationToken>{start + self.page_size}</NextContinuationToken>")
+        body += [f"<Contents><Key>{escape(key)}</Key><Size>{len(self.objects[key])}</Size></Contents>" for key in page]
+        body.append("</ListBucketResult>")
+        return web.Response(text="".join(body), content_type="application/xml")
+
+    async def start(self) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/{bucket}", self.handle)
+        app.router.add_route("*", "/{bucket}/{key:.+}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+# ─────────────────────────────────────────────────────────────
+# Сценарии (в дочернем процессе, по одному на размер корпуса)
+# ─────────────────────────────────────────────────────────────
+def timed(results: dict, name: str, started: float, **extra) -> None:
+    results[name] = {"seconds": round(time.perf_counter() - started, 6), **extra}
+
+def make_update(update_id: int, text: str, chat_id: int = 1) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "text": text,
+        },
+    }
+
+async def run_scenarios(args) -> dict:
+    import alnbot
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    results = {"size": args.worker}
+    # on_startup здесь не вызывается — план поднимаем сами, хендлеры ждать не должны
+    alnbot.startup_done.set()
+
+    started = time.perf_counter()
+    await alnbot.load_and_move_materials()
+    timed(results, "load_and_move_materials", started, pairs=len(alnbot.material_pairs))
+
+    started = time.perf_counter()
+    await alnbot.sync_material_queue()
+    timed(results, "reload_noop", started)
+
+    started = time.perf_counter()
+    alnbot.schedule_posts()
+    timed(results, "schedule_posts", started, tasks=len(alnbot.scheduled_tasks))
+
+    rounds = 100
+    started = time.perf_counter()
+    for _ in range(rounds):
+        alnbot.get_scheduled_publications_info(limit=50)
+    timed(results, "get_scheduled_publications_info", started, rounds=rounds)
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await alnbot.refresh_material_queue()
+    timed(results, "refresh_material_queue", started, rounds=rounds)
+
+    # Пропускная способность вебхука: POST → очередь воркера → диспетчер → хендлер → sendMessage в заглушку.
+    # Обработчик тот же, что в main(): ответ уходит сразу, поэтому замер идёт до разбора всех очередей
+    app = web.Application(middlewares=[alnbot.webhook_timing])
+    handler = alnbot.QueuedRequestHandler(
+        alnbot.dp, alnbot.bot, alnbot.WEBHOOK_WORKERS, alnbot.WEBHOOK_QUEUE_SIZE, alnbot.WEBHOOK_DEDUP_SIZE,
+    )
+    handler.register(app, path="/webhook")
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    webhook_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/webhook"
+    gate = asyncio.Semaphore(args.concurrency)
+    busy = 0
+
+    async def post(session, update_id):
+        nonlocal busy
+        update = make_update(update_id, "📅 Расписание", chat_id=update_id % args.chats + 1)
+        async with gate:
+            while True:
+                async with session.post(webhook_url, json=update) as resp:
+                    await resp.read()
+                if resp.status != 503:
+                    break
+                # Очередь воркера полна — повторяем, как сделал бы Telegram
+                busy += 1
+                await asyncio.sleep(0.01)
+
+    async with ClientSession() as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(post(session, i) for i in range(1, args.updates + 1)))
+        await handler.drain()
+        elapsed = time.perf_counter() - started
+    await handler.close()
+    await runner.cleanup()
+    results["webhook"] = {
+        "seconds": round(elapsed, 6),
+        "updates": args.updates,
+        "per_second": round(args.updates / elapsed, 1),
+        "busy_retries": busy,
+    }
+
+    # Длительная отправка: реальный путь outbox → лимиты → send_photo, без повторов
+    pairs = alnbot.material_pairs.head(args.sends)
+    started = time.perf_counter()
+    for idx, (image_path, text_path) in enumerate(pairs):
+        alnbot.outbox_add(image_path, text_path, idx, alnbot.CHAT_IDS)
+    await asyncio.gather(*(
+        alnbot.send_material_pair(image_path, text_path, idx) for idx, (image_path, text_path) in enumerate(pairs)
+    ))
+    elapsed = time.perf_counter() - started
+    retrying, dead = alnbot.outbox_counts()
+    deliveries = len(pairs) * len(alnbot.CHAT_IDS)
+    results["send"] = {
+        "seconds": round(elapsed, 6),
+        "pairs": len(pairs),
+        "deliveries": deliveries,
+        "per_second": round(deliveries / elapsed, 1) if elapsed else None,
+        "retrying": retrying,
+        "dead_letters": dead,
+    }
+    alnbot.prefetcher.stop()
+    await alnbot.storage.close()
+    return results
+
+async def worker_main(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f"alnbench-{args.worker}-")
+    try:
+        generate_corpus(os.path.join(workdir, "materials"), args.worker, args.image_bytes)
+        api = FakeBotAPI(args.latency, args.rate_429)
+        base_url = await api.start()
+        s3 = None
+        if args.storage == "s3":
+            # Корпус переезжает в бакет: дальше alnbot работает с ним только через S3Storage
+            s3 = FakeS3("alnbench")
+            materials = os.path.join(workdir, "materials")
+            for name in os.listdir(materials):
+                with open(os.path.join(materials, name), "rb") as f:
+                    s3.put(f"bench/materials/{name}", f.read())
+            shutil.rmtree(materials)
+            os.environ.update({
+                "STORAGE_BACKEND": "s3",
+                "S3_ENDPOINT": await s3.start(),
+                "S3_BUCKET": s3.bucket,
+                "S3_ACCESS_KEY": "bench",
+                "S3_SECRET_KEY": "bench",
+                "S3_PREFIX": "bench/",
+            })
+        os.environ.update({
+            "BOT_TOKEN": BENCH_TOKEN,
+            "CHAT_IDS": ",".join(CHAT_IDS),
+            "TELEGRAM_API_URL": base_url,
+            "STATE_DIR": os.path.join(workdir, "state"),
+            "MATERIALS_DIR": os.path.join(workdir, "materials"),
+            "WAIT_DIR": os.path.join(workdir, "wait"),
+            "OPTIMIZE_IMAGES": "0",
+            "GLOBAL_SEND_RATE": str(args.send_rate),
+            "PER_CHAT_PER_MINUTE": str(args.send_rate * 60),
+        })
+        try:
+            results = await run_scenarios(args)
+        finally:
+            await api.stop()
+            if s3 is not None:
+                await s3.stop()
+        results["fake_api"] = {"calls": api.calls, "throttled": api.throttled, "uploaded_bytes": api.uploaded_bytes}
+        if s3 is not None:
+            results["fake_s3"] = {"calls": s3.calls, "objects_left": len(s3.objects), "streamed_bytes": s3.streamed_bytes}
+        return results
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# ─────────────────────────────────────────────────────────────
+# Запуск
+# ─────────────────────────────────────────────────────────────
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк alnbot на синтетическом корпусе")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="размеры корпуса через запятую")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка заглушки Bot API, сек")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--updates", type=int, default=1000, help="апдейтов в замере вебхука")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных POST на вебхук")
+    parser.add_argument("--chats", type=int, default=16, help="разных чатов среди апдейтов вебхука")
+    parser.add_argument("--sends", type=int, default=200, help="пар в замере отправки")
+    parser.add_argument("--send-rate", type=float, default=1000, help="лимит отправок в секунду на время замера")
+    parser.add_argument("--image-bytes", type=int, default=64 * 1024, help="размер синтетической картинки")
+    parser.add_argument("--storage", choices=("local", "s3"), default="local", help="хранилище материалов (s3 — заглушка в памяти)")
+    parser.add_argument("--output", help="файл для JSON (по умолчанию stdout)")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи alnbot")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.worker is not None:
+        print(json.dumps(asyncio.run(worker_main(args)), ensure_ascii=False))
+        return
+
+    report = {"params": {k: v for k, v in vars(args).items() if k not in ("worker", "output")}, "runs": []}
+    for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+        command = [sys.executable, os.path.abspath(__file__), "--worker", str(size)]
+        for name in ("latency", "rate_429", "updates", "concurrency", "chats", "sends", "send_rate", "image_bytes", "storage"):
+            command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+        if args.verbose:
+            command.append("--verbose")
+        print(f"Корпус {size}...", file=sys.stderr)
+        started = time.perf_counter()
+        proc = subprocess.run(command, capture_output=True, text=True)
+        if proc.returncode != 0:
+            report["runs"].append({"size": size, "error": proc.stderr[-2000:]})
+            continue
+        run = json.loads(proc.stdout.strip().splitlines()[-1])
+        run["total_seconds"] = round(time.perf_counter() - started, 3)
+        report["runs"].append(run)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()